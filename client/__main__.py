@@ -4,6 +4,7 @@ from __future__ import annotations
 
 
 import logging, threading
+import queue
 import asyncio
 import json
 import os
@@ -13,14 +14,19 @@ try:
     import wmi
 except ImportError:
     wmi = None
-import re
+try:
+    import pythoncom
+except ImportError:
+    pythoncom = None
 import sys
 import time
 from datetime import timedelta
+from ipaddress import AddressValueError, IPv4Address
 from pathlib import Path
 from typing import List, Optional
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 import psutil
 from PIL import Image
@@ -40,6 +46,9 @@ GPU_METRIC_FUNCS: list = []
 NVML_INITED = False
 NVML_HANDLE = None
 CPU_CORES = psutil.cpu_count(logical=False) or psutil.cpu_count() or 1
+IS_WINDOWS = platform.system() == "Windows"
+# время загрузки ОС не меняется за время работы агента
+_BOOT_TIME = psutil.boot_time()
 import websockets
 WS_LOOP: asyncio.AbstractEventLoop | None = None
 WS_CONN: websockets.WebSocketClientProtocol | None = None
@@ -48,6 +57,21 @@ try:
     import pynvml
 except Exception:
     pynvml = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _dumps(obj) -> str:
+    """Сериализовать сообщение для WS (orjson, если установлен)."""
+    if orjson is not None:
+        # сервер читает текстовые кадры, поэтому отдаём str, а не bytes
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+_loads = orjson.loads if orjson is not None else json.loads
 
 if os.name == "nt":
     import ctypes
@@ -96,55 +120,38 @@ else:
 
 
 log = logging.getLogger("pc-agent")
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+# journald (systemd) сам ставит метку времени: asctime там не форматируем
+_LOG_FORMAT = "[%(levelname)s] %(message)s"
+if not os.getenv("JOURNAL_STREAM"):
+    _LOG_FORMAT = "%(asctime)s " + _LOG_FORMAT
+logging.basicConfig(level=logging.INFO, format=_LOG_FORMAT)
+# поток/процесс в формате не выводятся — не собираем их для каждой записи
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
 
 ENV_FILE = Path(".env")
 
 # ────────────────────────── load .env → os.environ ─────────────────────────
-if ENV_FILE.exists():
-    for line in ENV_FILE.read_text().splitlines():
-        if "=" in line and not line.lstrip().startswith("#"):
-            k, v = line.split("=", 1)
-            os.environ.setdefault(k.strip(), v.strip())
+# файл читается один раз; новые значения дописываются одним append в конце
+ENV_TEXT = ENV_FILE.read_text() if ENV_FILE.exists() else ""
+for k, v in (
+    line.split("=", 1)
+    for line in ENV_TEXT.splitlines()
+    if "=" in line and not line.lstrip().startswith("#")
+):
+    os.environ.setdefault(k.strip(), v.strip())
+ENV_NEW: list[str] = []
 
 # ────────────────────────── prompt helpers ─────────────────────────────────
-IP_RE = re.compile(r"^(?:\d{1,3}\.){3}\d{1,3}$")
-
 def prompt_ip() -> str:
     while True:
         ip = input("Enter SERVER IPv4 [127.0.0.1]: ").strip() or "127.0.0.1"
-        if IP_RE.match(ip):
+        try:
+            IPv4Address(ip)
             return ip
-        print("❌ Invalid IPv4, try again (e.g. 192.168.1.42)")
-
-# ──────────────────── fingerprint pinning ────────────────────────
-import hashlib, json, ssl, pathlib
-FP_FILE = pathlib.Path.home() / ".bot_fingerprint.json"
-
-def _cert_fp(cert_bin: bytes) -> str:
-    return hashlib.sha256(cert_bin).hexdigest()
-
-def _load_fp() -> str | None:
-    if FP_FILE.exists():
-        return json.loads(FP_FILE.read_text()).get("fp")
-
-def _save_fp(fp: str):
-    FP_FILE.write_text(json.dumps({"fp": fp}))
-
-def _ctx_with_pinning(pinned: str | None) -> ssl.SSLContext:
-    ctx = ssl.create_default_context()
-    if pinned:
-        # проверяем, что отпечаток совпадает
-        def _verify_cb(conn, cert, errno, depth, ok):
-            return ok and _cert_fp(cert.as_binary()) == pinned
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_REQUIRED
-        ctx.set_verify(ssl.CERT_REQUIRED, _verify_cb)
-    else:
-        # первый запуск: временно без проверки
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
-    return ctx
+        except AddressValueError:
+            print("❌ Invalid IPv4, try again (e.g. 192.168.1.42)")
 
 # ────────────────────────── CONFIG values ──────────────────────────────────
 
@@ -153,12 +160,18 @@ if not SECRET:
     print("AGENT_SECRET required"); sys.exit(1)
 
 if "AGENT_SECRET" not in os.environ:
-    ENV_FILE.write_text((ENV_FILE.read_text() if ENV_FILE.exists() else "") + f"AGENT_SECRET={SECRET}\n")
+    ENV_NEW.append(f"AGENT_SECRET={SECRET}\n")
 
 SERVER_IP = os.getenv("AGENT_SERVER_IP")
 if not SERVER_IP:
     SERVER_IP = prompt_ip()
-    ENV_FILE.write_text((ENV_FILE.read_text() if ENV_FILE.exists() else "") + f"AGENT_SERVER_IP={SERVER_IP}\n")
+    ENV_NEW.append(f"AGENT_SERVER_IP={SERVER_IP}\n")
+
+if ENV_NEW:
+    if ENV_TEXT and not ENV_TEXT.endswith("\n"):
+        ENV_NEW.insert(0, "\n")
+    with ENV_FILE.open("a") as f:
+        f.write("".join(ENV_NEW))
 
 PORT = int(os.getenv("AGENT_PORT", "8000"))
 
@@ -234,19 +247,25 @@ log.info(
 
 
 
-def gather_disks_metrics() -> List[dict]:
-    EXCL_FSTYPES        = {"tmpfs", "devtmpfs", "squashfs", "overlay", "aufs"}
-    EXCL_DEV_PREFIXES   = ("/dev/loop",)                     # snap-loop’ы и пр.
-    EXCL_MOUNT_PREFIXES = ("/snap", "/var/lib/docker", "/var/snap", "/boot")
-    MIN_SIZE_BYTES      = 1 << 30                           # 1 ГиБ
+EXCL_FSTYPES        = {"tmpfs", "devtmpfs", "squashfs", "overlay", "aufs"}
+EXCL_DEV_PREFIXES   = ("/dev/loop",)                     # snap-loop’ы и пр.
+EXCL_MOUNT_PREFIXES = ("/snap", "/var/lib/docker", "/var/snap", "/boot")
+MIN_SIZE_BYTES      = 1 << 30                           # 1 ГиБ
+
+# таблица монтирования меняется редко: отфильтрованный список точек
+# монтирования обновляется не чаще раза в _PARTS_TTL секунд
+_PARTS_TTL = 300
+_parts_cache: dict[str, object] = {"ts": 0.0, "parts": []}
+
 
-    res, seen = [], set()
+def _refresh_partitions() -> List[str]:
+    mounts, seen = [], set()
 
     for part in psutil.disk_partitions(all=False):
         if (part.mountpoint in seen
             or part.fstype.lower()            in EXCL_FSTYPES
             or part.device.startswith(EXCL_DEV_PREFIXES)
-            or any(part.mountpoint.startswith(p) for p in EXCL_MOUNT_PREFIXES)):
+            or part.mountpoint.startswith(EXCL_MOUNT_PREFIXES)):
             continue
         seen.add(part.mountpoint)
 
@@ -257,8 +276,31 @@ def gather_disks_metrics() -> List[dict]:
 
         if u.total < MIN_SIZE_BYTES:
             continue
+        mounts.append(part.mountpoint)
+
+    return mounts
+
+
+def _partitions() -> List[str]:
+    now = time.monotonic()
+    if not _parts_cache["ts"] or now - _parts_cache["ts"] >= _PARTS_TTL:
+        _parts_cache["parts"] = _refresh_partitions()
+        _parts_cache["ts"] = now
+    return _parts_cache["parts"]
+
+
+def gather_disks_metrics() -> List[dict]:
+    res = []
+
+    for mount in _partitions():
+        try:
+            u = psutil.disk_usage(mount)
+        except OSError:
+            # диск отключён: при следующем опросе перечитываем таблицу
+            _parts_cache["ts"] = 0.0
+            continue
         res.append({
-            "mount": part.mountpoint,
+            "mount": mount,
             "percent": u.percent,
             "used": u.used,
             "total": u.total,
@@ -312,36 +354,121 @@ def gather_top_processes(count: int = 5) -> List[dict]:
     res.sort(key=lambda x: x["cpu"], reverse=True)
     return res[:count]
 
+# Температура CPU меняется медленно, поэтому датчики опрашиваются
+# не чаще одного раза в _CPU_TEMP_TTL секунд
+_CPU_TEMP_TTL = 30
+_cpu_temp_cache: dict[str, object] = {"ts": 0.0, "val": None}
+_CPU_TEMP_SENSORS = ("coretemp", "k10temp", "cpu_thermal")
+_HWMON_TEMP: Path | None = None
+_HWMON_PROBED = False
+
+
+def _find_hwmon_temp() -> Path | None:
+    """Найти файл temp1_input датчика CPU в /sys/class/hwmon (один раз)."""
+    global _HWMON_TEMP, _HWMON_PROBED
+    if _HWMON_PROBED:
+        return _HWMON_TEMP
+    _HWMON_PROBED = True
+    found: dict[str, Path] = {}
+    for hw in Path("/sys/class/hwmon").glob("hwmon*"):
+        try:
+            name = (hw / "name").read_text().strip()
+        except OSError:
+            continue
+        inp = hw / "temp1_input"
+        if name in _CPU_TEMP_SENSORS and inp.exists():
+            found.setdefault(name, inp)
+    for name in _CPU_TEMP_SENSORS:
+        if name in found:
+            _HWMON_TEMP = found[name]
+            break
+    return _HWMON_TEMP
+
+
 def get_cpu_temp() -> str | None:
+    now = time.monotonic()
+    if _cpu_temp_cache["ts"] and now - _cpu_temp_cache["ts"] < _CPU_TEMP_TTL:
+        return _cpu_temp_cache["val"]
+    val = _read_cpu_temp()
+    _cpu_temp_cache["ts"] = now
+    _cpu_temp_cache["val"] = val
+    return val
+
+
+def _read_cpu_temp() -> str | None:
+    # ── 0) Linux: читаем только нужный файл hwmon ─────────
+    if sys.platform.startswith("linux"):
+        path = _find_hwmon_temp()
+        if path:
+            try:
+                return f"{int(path.read_text()) / 1000:.1f} °C"
+            except (OSError, ValueError):
+                pass
+
     # ── 1) стандартный psutil ─────────────────────────────
     try:
         temps = psutil.sensors_temperatures()
         if temps:
-            for name in ("coretemp", "k10temp", "cpu_thermal"):
+            for name in _CPU_TEMP_SENSORS:
                 if name in temps and temps[name]:
                     return f"{temps[name][0].current:.1f} °C"
     except Exception:
         pass
 
     # ── 2) Windows: Open/Libre Hardware Monitor через WMI ─
-    if platform.system() == "Windows" and wmi:
-        for namespace in ("root\\OpenHardwareMonitor",
-                          "root\\LibreHardwareMonitor"):
-            try:
-                c = wmi.WMI(namespace=namespace)
-                sensors = c.Sensor()  # все датчики
-                for s in sensors:
-                    if s.SensorType == u"Temperature" and "CPU" in s.Name:
-                        return f"{s.Value:.1f} °C"
-            except Exception:
-                continue
+    if IS_WINDOWS and wmi:
+        return _wmi_cpu_temp()
+
+    return None
+
+
+# WMI-подключение и найденный датчик переиспользуются между опросами
+_wmi_ctx = None
+_wmi_cpu_sensor = None
+
 
+def _wmi_find_cpu_sensor():
+    """Найти датчик температуры CPU в пространствах имён Open/Libre HM."""
+    global _wmi_ctx, _wmi_cpu_sensor
+    for namespace in ("root\\OpenHardwareMonitor",
+                      "root\\LibreHardwareMonitor"):
+        try:
+            c = wmi.WMI(namespace=namespace)
+            for s in c.Sensor(SensorType="Temperature"):
+                if "CPU" in s.Name:
+                    _wmi_ctx, _wmi_cpu_sensor = c, s
+                    return s
+        except Exception:
+            continue
+    return None
+
+
+def _wmi_cpu_temp() -> str | None:
+    global _wmi_ctx, _wmi_cpu_sensor
+    for _ in range(2):
+        sensor = _wmi_cpu_sensor or _wmi_find_cpu_sensor()
+        if sensor is None:
+            return None
+        try:
+            # Refresh_ перечитывает свойства объекта без нового перебора датчиков
+            sensor.ole_object.Refresh_()
+            return f"{sensor.Value:.1f} °C"
+        except Exception:
+            # провайдер перезапущен или COM-ссылка устарела: ищем датчик заново
+            _wmi_ctx = _wmi_cpu_sensor = None
     return None
+
+
+# пути к CLI-утилитам ищутся в PATH один раз при старте
+NVIDIA_SMI = shutil.which("nvidia-smi")
+AMD_SMI = shutil.which("amd-smi")
+
+
 def _nvidia_gpu_metrics() -> dict | None:
     """Try reading metrics using NVIDIA-specific tools."""
-    if pynvml and NVML_INITED:
+    if pynvml and NVML_HANDLE is not None:
         try:
-            h = NVML_HANDLE or pynvml.nvmlDeviceGetHandleByIndex(0)
+            h = NVML_HANDLE
             util = pynvml.nvmlDeviceGetUtilizationRates(h).gpu
             mem = pynvml.nvmlDeviceGetMemoryInfo(h)
             temp = pynvml.nvmlDeviceGetTemperature(h, pynvml.NVML_TEMPERATURE_GPU)
@@ -353,25 +480,22 @@ def _nvidia_gpu_metrics() -> dict | None:
                 "gpu_temp": float(temp),
             }
         except Exception:
-            pass
+            # NVML работает: не откатываемся на запуск nvidia-smi каждый тик
+            return None
 
-    if shutil.which("nvidia-smi"):
+    if NVIDIA_SMI:
         try:
-            util, used, total, temp = map(
-                float,
-                re.split(
-                    r",\s*",
-                    subprocess.check_output(
-                        [
-                            "nvidia-smi",
-                            "--query-gpu=utilization.gpu,memory.used,memory.total,temperature.gpu",
-                            "--format=csv,noheader,nounits",
-                        ],
-                        text=True,
-                        timeout=2,
-                    ).strip(),
-                ),
+            out = subprocess.check_output(
+                [
+                    NVIDIA_SMI,
+                    "--query-gpu=utilization.gpu,memory.used,memory.total,temperature.gpu",
+                    "--format=csv,noheader,nounits",
+                ],
+                text=True,
+                timeout=2,
             )
+            # float() сам отбрасывает пробелы, регулярка не нужна
+            util, used, total, temp = map(float, out.splitlines()[0].split(","))
             return {
                 "gpu": util,
                 "vram_used": used,
@@ -403,7 +527,7 @@ def _nvidia_gpu_metrics() -> dict | None:
 
 def _windows_wmi_amd_metrics() -> dict | None:
     """Fallback metrics via Windows WMI performance counters."""
-    if platform.system() != "Windows" or not wmi:
+    if not IS_WINDOWS or not wmi:
         return None
     try:
         c = wmi.WMI(namespace="root\\CIMV2")
@@ -462,10 +586,10 @@ def _amd_gpu_metrics() -> dict | None:
     except Exception:
         pass
 
-    if shutil.which("amd-smi"):
+    if AMD_SMI:
         try:
             out = subprocess.check_output(
-                ["amd-smi", "metric", "--json", "--gpu", "0"],
+                [AMD_SMI, "metric", "--json", "--gpu", "0"],
                 text=True,
                 timeout=2,
             )
@@ -486,7 +610,7 @@ def _amd_gpu_metrics() -> dict | None:
         except Exception:
             pass
 
-    if platform.system() == "Windows":
+    if IS_WINDOWS:
         data = _windows_wmi_amd_metrics()
         if data:
             return data
@@ -535,7 +659,7 @@ def _amd_gpu_metrics() -> dict | None:
 
 def detect_gpu_vendor() -> str | None:
     """Return 'nvidia', 'amd' or None if unknown."""
-    if platform.system() == "Windows":
+    if IS_WINDOWS:
         if wmi:
             try:
                 c = wmi.WMI()
@@ -584,9 +708,33 @@ def detect_gpu_vendor() -> str | None:
     return None
 
 
+def _init_nvml() -> None:
+    """Инициализировать NVML и получить дескриптор GPU один раз за процесс."""
+    global NVML_INITED, NVML_HANDLE
+    if NVML_INITED or not pynvml:
+        return
+    try:
+        pynvml.nvmlInit()
+    except Exception:
+        return
+    NVML_INITED = True
+    atexit.register(pynvml.nvmlShutdown)
+    try:
+        NVML_HANDLE = pynvml.nvmlDeviceGetHandleByIndex(0)
+    except Exception:
+        NVML_HANDLE = None
+
+
 def init_gpu_metrics() -> None:
-    """Определить производителя GPU и рабочие функции чтения метрик."""
-    global GPU_VENDOR, GPU_METRIC_FUNCS, NVML_INITED, NVML_HANDLE
+    """Определить производителя GPU и рабочие функции чтения метрик.
+
+    Выполняется один раз: повторные вызовы (после переподключения WS)
+    ничего не делают.
+    """
+    global GPU_VENDOR, GPU_METRIC_FUNCS
+
+    if GPU_METRIC_FUNCS:
+        return
 
     GPU_VENDOR = detect_gpu_vendor()
 
@@ -598,28 +746,19 @@ def init_gpu_metrics() -> None:
     else:
         candidates = [_nvidia_gpu_metrics, _amd_gpu_metrics]
 
-    GPU_METRIC_FUNCS = []
-
-    if GPU_VENDOR == "nvidia" and pynvml:
-        try:
-            pynvml.nvmlInit()
-            NVML_INITED = True
-            NVML_HANDLE = pynvml.nvmlDeviceGetHandleByIndex(0)
-            atexit.register(pynvml.nvmlShutdown)
-        except Exception:
-            NVML_INITED = False
-            NVML_HANDLE = None
+    if GPU_VENDOR in ("nvidia", None):
+        _init_nvml()
 
+    funcs = []
     for fn in candidates:
         try:
             data = fn()
             if data:
-                GPU_METRIC_FUNCS.append(fn)
+                funcs.append(fn)
         except Exception:
             continue
 
-    if not GPU_METRIC_FUNCS:
-        GPU_METRIC_FUNCS = candidates
+    GPU_METRIC_FUNCS = funcs or candidates
 
 
 def gather_gpu_metrics() -> dict | None:
@@ -632,6 +771,25 @@ def gather_gpu_metrics() -> dict | None:
             continue
     return None
 
+
+# GPU опрашивается раз в GPU_EVERY тиков, в остальные тики отдаются
+# последние значения
+GPU_EVERY = max(int(os.getenv("AGENT_GPU_EVERY_N_TICKS", "2")), 1)
+_gpu_tick = 0
+_gpu_cache: dict | None = None
+
+
+def gather_gpu_metrics_throttled(force: bool = False) -> dict | None:
+    global _gpu_tick, _gpu_cache
+    if force:
+        # внеочередной опрос (/status) не сдвигает расписание регулярных
+        _gpu_cache = gather_gpu_metrics()
+        return _gpu_cache
+    if _gpu_tick % GPU_EVERY == 0:
+        _gpu_cache = gather_gpu_metrics()
+    _gpu_tick += 1
+    return _gpu_cache
+
 # ──────────────────────── network usage ─────────────────────────-
 NET_LAST = None
 
@@ -666,25 +824,96 @@ def gather_net_usage():
     # даже если трафика нет, возвращаем 0, а не None
     return up / INTERVAL, down / INTERVAL
 
-def gather_metrics(full: bool = False) -> dict:
+# ──────────────────────── CPU / RAM / swap ─────────────────────────
+_prev_cpu_times: tuple[int, int] | None = None
+
+
+def _read_proc_meminfo_stat() -> tuple[float, tuple, tuple]:
+    """Прочитать CPU, RAM и swap за одно чтение /proc/meminfo и /proc/stat.
+
+    Значения считаются так же, как в psutil (cpu_percent, virtual_memory,
+    swap_memory); CPU — дельта относительно предыдущего вызова.
+    """
+    global _prev_cpu_times
+    with open("/proc/meminfo", "rb") as f:
+        meminfo = f.read()
+    with open("/proc/stat", "rb") as f:
+        cpu_line = f.readline()
+
+    info: dict[bytes, int] = {}
+    for line in meminfo.splitlines():
+        key, _, rest = line.partition(b":")
+        fields = rest.split()
+        if fields:
+            info[key] = int(fields[0]) * 1024
+
+    total = info[b"MemTotal"]
+    free = info.get(b"MemFree", 0)
+    cached = info.get(b"Cached", 0) + info.get(b"SReclaimable", 0)
+    buffers = info.get(b"Buffers", 0)
+    avail = info.get(b"MemAvailable", free + cached + buffers)
+    used = total - free - cached - buffers
+    if used < 0:
+        used = total - free
+    mem = ((total - avail) / total * 100 if total else 0.0, used, total)
+
+    sw_total = info.get(b"SwapTotal", 0)
+    sw_used = sw_total - info.get(b"SwapFree", 0)
+    swap = (sw_used / sw_total * 100 if sw_total else 0.0, sw_used, sw_total)
+
+    # user nice system idle iowait irq softirq steal guest guest_nice
+    times = [int(x) for x in cpu_line.split()[1:]]
+    cpu_total = sum(times[:8])
+    cpu_idle = times[3] + (times[4] if len(times) > 4 else 0)
+    cpu = 0.0
+    if _prev_cpu_times is not None:
+        d_total = cpu_total - _prev_cpu_times[0]
+        d_idle = cpu_idle - _prev_cpu_times[1]
+        if d_total > 0:
+            cpu = round(max(0.0, min(100.0, (d_total - d_idle) / d_total * 100)), 1)
+    _prev_cpu_times = (cpu_total, cpu_idle)
+    return cpu, mem, swap
+
+
+def _read_cpu_mem_swap() -> tuple[float, tuple, tuple]:
+    """Вернуть (cpu %, (ram %, used, total), (swap %, used, total))."""
+    if sys.platform.startswith("linux"):
+        try:
+            return _read_proc_meminfo_stat()
+        except (OSError, KeyError, ValueError, IndexError):
+            pass
     cpu = psutil.cpu_percent(interval=None)
     mem = psutil.virtual_memory()
     swap = psutil.swap_memory()
+    return (
+        cpu,
+        (mem.percent, mem.used, mem.total),
+        (swap.percent, swap.used, swap.total),
+    )
+
+
+# первый замер задаёт точку отсчёта: дальше CPU считается без блокировки
+# как дельта между соседними опросами (интервал ≥ AGENT_INTERVAL)
+_read_cpu_mem_swap()
+
+
+def gather_metrics(full: bool = False) -> dict:
+    cpu, mem, swap = _read_cpu_mem_swap()
     net_up, net_down = gather_net_usage()
     cpu_temp = None
     tmp = get_cpu_temp()
     if tmp and tmp.split()[0].replace('.', '', 1).isdigit():
         cpu_temp = float(tmp.split()[0])
-    uptime = int(time.time() - psutil.boot_time())
-    gpu_data = gather_gpu_metrics() or {}
+    uptime = int(time.time() - _BOOT_TIME)
+    gpu_data = gather_gpu_metrics_throttled(force=full) or {}
     data = {
         "cpu": cpu,
-        "ram": mem.percent,
-        "ram_used": mem.used,
-        "ram_total": mem.total,
-        "swap": swap.percent,
-        "swap_used": swap.used,
-        "swap_total": swap.total,
+        "ram": mem[0],
+        "ram_used": mem[1],
+        "ram_total": mem[2],
+        "swap": swap[0],
+        "swap_used": swap[1],
+        "swap_total": swap[2],
         "cpu_temp": cpu_temp,
         "uptime": uptime,
         **gpu_data,
@@ -701,11 +930,37 @@ def gather_metrics(full: bool = False) -> dict:
 
 
 # ---------- async speedtest helper ----------
-speedtest_running = False      # флаг «тест уже идёт»
-diag_running = False
+# по одному постоянному потоку на задачу: команды приходят через очередь,
+# поток не создаётся на каждую команду. Потоки daemon, чтобы выход из трея
+# и Ctrl+C не ждали окончания долгого speedtest или dxdiag. Поднятый флаг
+# busy означает «задача уже идёт».
+def _job_worker(job, jobs: queue.Queue, busy: threading.Event) -> None:
+    while True:
+        jobs.get()
+        try:
+            job()
+        finally:
+            busy.clear()
+
+
+def _start_job_worker(job, name: str) -> tuple[queue.Queue, threading.Event]:
+    jobs: queue.Queue = queue.Queue()
+    busy = threading.Event()
+    threading.Thread(
+        target=_job_worker, args=(job, jobs, busy), name=name, daemon=True
+    ).start()
+    return jobs, busy
+
+
+def _submit_job(jobs: queue.Queue, busy: threading.Event) -> bool:
+    """Передать задачу её потоку; False — если она уже выполняется."""
+    if busy.is_set():
+        return False
+    busy.set()
+    jobs.put(None)
+    return True
 
 def _speedtest_job():
-    global speedtest_running
     try:
         push_text("⏳ Тестируем скорость…")
         dl, ul, ping = submit(run_speedtest).result()
@@ -718,14 +973,20 @@ def _speedtest_job():
             push_text("⚠️  Speedtest не удался.")
     except Exception as exc:
         log.error("speedtest job error: %s", exc)
-    finally:
-        speedtest_running = False
 
 
 def ws_send(obj: dict) -> None:
     if WS_CONN and WS_LOOP:
+        try:
+            in_loop = asyncio.get_running_loop() is WS_LOOP
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            # вызов из самого цикла WS: ждать результата здесь — взаимоблокировка
+            WS_LOOP.create_task(WS_CONN.send(_dumps(obj)))
+            return
         fut = asyncio.run_coroutine_threadsafe(
-            WS_CONN.send(json.dumps(obj)), WS_LOOP
+            WS_CONN.send(_dumps(obj)), WS_LOOP
         )
         try:
             fut.result()
@@ -739,7 +1000,6 @@ def push_diag(txt: str, ok: bool = True):
     ws_send({"diag": txt, "diag_ok": ok})
 
 def _diag_job():
-    global diag_running
     try:
         push_text("⏳ Собираем диагностику…")
         out = submit(run_diagnostics).result()
@@ -749,14 +1009,13 @@ def _diag_job():
             push_diag("", ok=False)
     except Exception as exc:
         log.error("diagnostics job error: %s", exc)
-    finally:
-        diag_running = False
+
+
+_speedtest_jobs, _speedtest_busy = _start_job_worker(_speedtest_job, "speedtest")
+_diag_jobs, _diag_busy = _start_job_worker(_diag_job, "diag")
 # ────── network layer: TLS TOFU + fingerprint pinning ────────────
-import ssl, socket, json, hashlib, pathlib, logging
-from urllib.parse import urlparse
-import sys
+import ssl, hashlib, pathlib
 
-log      = logging.getLogger(__name__)
 FP_FILE  = pathlib.Path.home() / ".bot_fingerprint.json"
 
 def _fingerprint(der: bytes) -> str:
@@ -766,14 +1025,45 @@ def _load_fp() -> str | None:
     return json.loads(FP_FILE.read_text())["fp"] if FP_FILE.exists() else None
 
 def _save_fp(fp: str) -> None:
-    FP_FILE.write_text(json.dumps({"fp": fp}))
+    global _PINNED_FP
+    # пишем во временный файл и атомарно подменяем: сбой посреди записи
+    # не оставит обрезанный JSON, из-за которого агент не запустится
+    tmp = FP_FILE.with_suffix(".tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.write(fd, json.dumps({"fp": fp}).encode())
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, FP_FILE)
+    _PINNED_FP = fp
+
+# отпечаток не меняется за время работы процесса: читаем файл один раз
+_PINNED_FP: str | None = _load_fp()
+
+# (сохранённый, полученный) отпечаток при несовпадении, см. _PinnedSSLObject
+_FP_MISMATCH: tuple[str, str] | None = None
+
 
-def _fetch_cert_der(parsed) -> bytes:
-    host, port = parsed.hostname, parsed.port or 443
-    ctx = ssl._create_unverified_context()
-    with socket.create_connection((host, port), timeout=5) as sock:
-        with ctx.wrap_socket(sock, server_hostname=host) as s:
-            return s.getpeercert(binary_form=True)
+class _PinnedSSLObject(ssl.SSLObject):
+    """SSLObject, проверяющий отпечаток сертификата сервера в рукопожатии.
+
+    Проверка идёт на том же TLS-соединении, что и WebSocket, поэтому отдельный
+    сокет для чтения сертификата не нужен, а при несовпадении соединение
+    обрывается до отправки запроса с секретом.
+    """
+
+    def do_handshake(self) -> None:
+        global _FP_MISMATCH
+        super().do_handshake()
+        current_fp = _fingerprint(self.getpeercert(binary_form=True))
+        pinned = _PINNED_FP
+        if pinned is None:
+            _save_fp(current_fp)
+            log.info("\ud83c\udf89  Cert saved, fp=%s\u2026", current_fp[:16])
+        elif pinned != current_fp:
+            _FP_MISMATCH = (pinned, current_fp)
+            raise ssl.SSLCertVerificationError("certificate fingerprint mismatch")
 
 def _mismatch_exit(pinned: str, new_fp: str) -> None:
     msg = (
@@ -794,18 +1084,6 @@ def _mismatch_exit(pinned: str, new_fp: str) -> None:
     print(msg, file=sys.stderr)
     sys.exit(1)
 
-def _ensure_fp(url: str) -> str:
-    pinned = _load_fp()
-    cert_der = _fetch_cert_der(urlparse(url))
-    current_fp = _fingerprint(cert_der)
-    if pinned is None:
-        _save_fp(current_fp)
-        log.info("\ud83c\udf89  Cert saved, fp=%s\u2026", current_fp[:16])
-    elif pinned != current_fp:
-        _mismatch_exit(pinned, current_fp)
-    return current_fp
-
-
 def push_text(txt: str):
     ws_send({"text": txt})
 
@@ -822,7 +1100,7 @@ def push_metrics(data: dict, oneshot: bool = False):
 
 def do_reboot():
     try:
-        if platform.system() == "Windows":
+        if IS_WINDOWS:
             subprocess.Popen(["shutdown", "/r", "/t", "0"], shell=False)
         else:
             subprocess.Popen(["sudo", "reboot"], shell=False)
@@ -832,7 +1110,7 @@ def do_reboot():
 
 def do_shutdown():
     try:
-        if platform.system() == "Windows":
+        if IS_WINDOWS:
             subprocess.Popen(["shutdown", "/s", "/t", "0"], shell=False)
         else:
             subprocess.Popen(["sudo", "shutdown", "-h", "now"], shell=False)
@@ -840,26 +1118,51 @@ def do_shutdown():
         log.error("shutdown failed: %s", e)
 
 
+# Сбор метрик (WMI, NVML, /proc) блокирующий: выполняем его в отдельном
+# потоке, чтобы цикл WS продолжал принимать команды. Один поток — потому что
+# gather_metrics хранит состояние между вызовами (дельты CPU и сети).
+# WMI работает через COM, который нужно инициализировать в каждом потоке.
+_GATHER_POOL = ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix="gather",
+    initializer=pythoncom.CoInitialize if pythoncom else None,
+)
+
+
+async def _gather(full: bool = False) -> dict:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_GATHER_POOL, gather_metrics, full)
+
+
 async def _send_metrics_loop(ws: websockets.WebSocketClientProtocol) -> None:
     """Периодическая отправка метрик."""
-    psutil.cpu_percent(interval=None)
-    gather_top_processes()
-    init_gpu_metrics()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_GATHER_POOL, gather_top_processes)
+    await loop.run_in_executor(_GATHER_POOL, init_gpu_metrics)
+    # расписание по монотонным дедлайнам: время сбора и отправки вычитается
+    # из паузы, и период остаётся равным INTERVAL без накопления дрейфа
+    next_tick = loop.time()
     while True:
         try:
-            metrics = gather_metrics()
-            await ws.send(json.dumps(metrics))
+            metrics = await _gather()
+            await ws.send(_dumps(metrics))
         except Exception as exc:
             log.error("WS send error: %s", exc)
             break
-        await asyncio.sleep(INTERVAL)
+        next_tick += INTERVAL
+        delay = next_tick - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            # не успели (долгий сбор или сеть): не догоняем пачкой, а сдвигаем сетку
+            next_tick = loop.time()
 
 
 async def _recv_loop(ws: websockets.WebSocketClientProtocol) -> None:
     """Получение команд от сервера."""
     while True:
         try:
-            resp = json.loads(await ws.recv())
+            resp = _loads(await ws.recv())
         except Exception as exc:
             log.error("WS recv error: %s", exc)
             break
@@ -869,19 +1172,17 @@ async def _recv_loop(ws: websockets.WebSocketClientProtocol) -> None:
             elif c == "shutdown":
                 log.info("cmd shutdown"); push_text("💤 Shutting down…"); do_shutdown()
             elif c == "speedtest":
-                if not speedtest_running:
+                if _submit_job(_speedtest_jobs, _speedtest_busy):
                     log.info("cmd speedtest (async)")
-                    threading.Thread(target=_speedtest_job, daemon=True).start()
                 else:
                     push_text("🚧 Speedtest уже выполняется, дождитесь окончания.")
             elif c == "diag":
-                if not diag_running:
+                if _submit_job(_diag_jobs, _diag_busy):
                     log.info("cmd diagnostics (async)")
-                    threading.Thread(target=_diag_job, daemon=True).start()
                 else:
                     push_text("🚧 Диагностика уже выполняется, дождитесь окончания.")
             elif c == "status":
-                await ws.send(json.dumps({**gather_metrics(full=True), "oneshot": True}))
+                await ws.send(_dumps({**await _gather(full=True), "oneshot": True}))
 
 
 async def ws_main() -> None:
@@ -898,7 +1199,7 @@ async def ws_main() -> None:
             ssl_ctx = ssl.create_default_context()
         else:
             ssl_ctx = ssl._create_unverified_context()
-    _ensure_fp(SERVER)
+        ssl_ctx.sslobject_class = _PinnedSSLObject
     while True:
         try:
             async with websockets.connect(uri, ssl=ssl_ctx) as ws:
@@ -914,6 +1215,8 @@ async def ws_main() -> None:
                     t.cancel()
                 await asyncio.gather(*pending, return_exceptions=True)
         except Exception as exc:
+            if _FP_MISMATCH:
+                _mismatch_exit(*_FP_MISMATCH)
             log.error("WS connection error: %s", exc)
         finally:
             WS_CONN = None
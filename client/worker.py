@@ -18,6 +18,7 @@ __all__ = [
 ]
 
 _executor = ProcessPoolExecutor()
+_IS_WINDOWS = platform.system() == "Windows"
 
 def submit(func, *args, **kwargs) -> Future:
     """Отправить функцию в пул процессов."""
@@ -30,7 +31,7 @@ def shutdown_executor() -> None:
 
 
 def _subprocess_flags() -> int:
-    if platform.system() == "Windows":
+    if _IS_WINDOWS:
         return subprocess.CREATE_NO_WINDOW
     return 0
 
@@ -75,7 +76,7 @@ def run_speedtest() -> tuple[float | None, float | None, float | None]:
 
 def run_diagnostics() -> str | None:
     try:
-        if platform.system() == "Windows":
+        if _IS_WINDOWS:
             dxdiag = shutil.which("dxdiag") or shutil.which("dxdiag.exe")
             if dxdiag:
                 tmp = Path(tempfile.gettempdir()) / "dxdiag.txt"
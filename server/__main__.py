@@ -2,10 +2,10 @@ from __future__ import annotations
 
 import functools
 from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 """remote_bot_server"""
 import asyncio
-import json
 import logging
 import os
 import re
@@ -14,35 +14,41 @@ from html import escape
 from telegram.constants import ParseMode
 from telegram.helpers import escape_markdown
 import time
-import string
 from telegram import InputFile
 import io
-import subprocess
 import sys
-import threading
 import multiprocessing as mp
+from collections import OrderedDict, deque
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Any, Dict, List, Optional
 
 import matplotlib
+import orjson
 import uvicorn
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
-from pydantic import BaseModel
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     Update,
 )
 from telegram.ext import (
-    Application,
     ApplicationBuilder,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
 )
 
-from .db import sql, load_db, save_db, record_metric, purge_old_metrics
+from .db import (
+    bucket_for,
+    delete_metrics,
+    latest_metrics,
+    latest_row,
+    load_db,
+    save_db,
+    record_metric,
+    purge_old_metrics,
+)
 from .graphs import (
     parse_timespan,
     plot_custom,
@@ -69,6 +75,10 @@ ACTIVE_WS: Dict[str, WebSocket] = {}
 # ссылка на экземпляр Telegram-приложения для отправки уведомлений
 TG_APP = None
 
+# ключи агентов из общего состояния: словарь живёт всё время работы,
+# поэтому горячий путь агентов обращается к нему напрямую
+_SECRETS: Dict[str, Dict[str, Any]] = load_db()["secrets"]
+
 CERT_FILE = Path(os.getenv("SSL_CERT", "cert.pem"))
 KEY_FILE = Path(os.getenv("SSL_KEY", "key.pem"))
 
@@ -77,45 +87,54 @@ matplotlib.use("Agg")
 
 # ────────────────────────── helpers ────────────────────────────────────────
 
-def _load_dotenv() -> None:
+def _load_dotenv() -> str:
+    """Загрузить .env в окружение; вернуть текст файла ("" если его нет)."""
     if not ENV_FILE.exists():
-        return
-    for line in ENV_FILE.read_text().splitlines():
-        if "=" in line and not line.lstrip().startswith("#"):
-            k, v = line.split("=", 1)
+        return ""
+    text = ENV_FILE.read_text()
+    for line in text.splitlines():
+        k, sep, v = line.partition("=")
+        if sep and not k.lstrip().startswith("#"):
             os.environ.setdefault(k.strip(), v.strip())
+    return text
 
 def _ensure_ssl() -> None:
     if CERT_FILE.exists() and KEY_FILE.exists():
         return
     logging.info("🔒 Generating self-signed TLS certificate…")
     try:
-        subprocess.run(
-            [
-                "openssl",
-                "req",
-                "-x509",
-                "-newkey",
-                "rsa:2048",
-                "-keyout",
-                str(KEY_FILE),
-                "-out",
-                str(CERT_FILE),
-                "-days",
-                "825",
-                "-nodes",
-                "-subj",
-                "/CN=localhost",
-            ],
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.x509.oid import NameOID
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+        now = datetime.now(timezone.utc)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now)
+            .not_valid_after(now + timedelta(days=825))
+            .sign(key, hashes.SHA256())
+        )
+        key_pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption(),
         )
+        fd = os.open(KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key_pem)
+        CERT_FILE.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
         logging.info("✅ Certificate created.")
     except Exception as exc:
         logging.warning("⚠️  TLS cert generation failed: %s", exc)
 
-_load_dotenv()
+ENV_TEXT = _load_dotenv()
 _ensure_ssl()
 
 TOKEN = os.getenv("BOT_TOKEN") or input("Enter Telegram BOT_TOKEN: ").strip()
@@ -123,9 +142,11 @@ if not TOKEN:
     print("❌ BOT_TOKEN required.")
     sys.exit(1)
 if "BOT_TOKEN" not in os.environ:
-    ENV_FILE.write_text(
-        (ENV_FILE.read_text() if ENV_FILE.exists() else "") + f"BOT_TOKEN={TOKEN}\n"
-    )
+    # дописываем в конец файла без повторного чтения и перезаписи
+    with ENV_FILE.open("a") as f:
+        if ENV_TEXT and not ENV_TEXT.endswith("\n"):
+            f.write("\n")
+        f.write(f"BOT_TOKEN={TOKEN}\n")
 
 logging.basicConfig(
     level=logging.INFO,
@@ -133,30 +154,36 @@ logging.basicConfig(
 )
 log = logging.getLogger("remote-bot")
 
+async def ws_send_json(ws: WebSocket, obj: Any) -> None:
+    """send_json() через orjson (текстовый фрейм, как и раньше)."""
+    await ws.send_text(orjson.dumps(obj).decode())
+
 async def send_or_queue(secret: str, cmd: str) -> None:
     """Попытаться отправить команду агенту через WebSocket либо поставить в очередь."""
     ws = ACTIVE_WS.get(secret)
     if ws:
         try:
-            await ws.send_json({"commands": [cmd]})
+            await ws_send_json(ws, {"commands": [cmd]})
             return
         except Exception as exc:
             log.warning("WS send failed: %s", exc)
-    db = load_db()
-    entry = db["secrets"].setdefault(secret, {})
-    entry.setdefault("pending", []).append(cmd)
-    save_db(db)
+    entry = _SECRETS.get(secret)
+    if entry is None:
+        # ключ удалён — не создаём для него пустую запись
+        return
+    entry.setdefault("pending", deque()).append(cmd)
+    save_db(load_db())
 
 UNIT_NAMES = ["B", "KiB", "MiB", "GiB", "TiB", "PiB"]
 # Для сетевой скорости используем биты
 UNIT_NAMES_BITS = ["bit", "Kbit", "Mbit", "Gbit", "Tbit", "Pbit"]
 
+_BYTE_UNITS = UNIT_NAMES + ["EiB"]
+
 def human_bytes(num: float) -> str:
-    for unit in UNIT_NAMES:
-        if num < 1024:
-            return f"{num:.1f} {unit}"
-        num /= 1024
-    return f"{num:.1f} EiB"
+    # номер единицы = число полных десятков бит (1 KiB = 2**10)
+    i = 0 if num < 1024 else min((int(num).bit_length() - 1) // 10, len(_BYTE_UNITS) - 1)
+    return f"{num / (1 << (10 * i)):.1f} {_BYTE_UNITS[i]}"
 
 def human_net_speed(num_bytes_per_sec: float) -> str:
     """Показать скорость в битах в секунду."""
@@ -179,58 +206,92 @@ def best_unit(max_val_bytes: float) -> tuple[float, str]:
     unit = UNIT_NAMES_BITS[idx] + "/s"
     return scale_bits / 8, unit
 
-def disk_bar(p: float, length: int = 10) -> str:
-    filled = int(round(p * length / 100))
-    return "█" * filled + "░" * (length - filled)
-
-async def run_plot(func, *args):
-    """Run plotting function in a temporary worker process."""
-    workers = os.getenv("GRAPH_WORKERS", "1")
-    try:
-        num = int(workers)
-    except ValueError:
-        num = 1
-    num = max(num, 1)
-    ctx = mp.get_context("spawn")
-    loop = asyncio.get_running_loop()
-    with ProcessPoolExecutor(max_workers=num, mp_context=ctx) as ex:
-        part = functools.partial(func, *args)
-        return await loop.run_in_executor(ex, part)
-async def check_speedtest_done(ctx: ContextTypes.DEFAULT_TYPE):
-    job  = ctx.job
-    data = job.data
-
-    secret  = data["secret"]
-    chat_id = data["chat_id"]
-    msg_id  = data["msg_id"]
+_BAR_LEN = 10
+_BAR_FULL = "█" * _BAR_LEN
+_BAR_EMPTY = "░" * _BAR_LEN
 
-    entry = load_db()["secrets"].get(secret, {})
+def disk_bar(p: float) -> str:
+    filled = min(max(int(round(p * _BAR_LEN / 100)), 0), _BAR_LEN)
+    return _BAR_FULL[:filled] + _BAR_EMPTY[filled:]
 
-    if "speedtest" in entry.get("pending", []):
-        return
+# пул процессов для графиков живёт всё время работы сервера: запуск
+# процесса с импортом matplotlib и подключением к MySQL стоит дороже самого графика
+_PLOT_POOL: ProcessPoolExecutor | None = None
 
-    status: str = LATEST_TEXT.get(secret, "")
-    if "Speedtest" not in status:
+def _plot_pool() -> ProcessPoolExecutor:
+    global _PLOT_POOL
+    if _PLOT_POOL is None:
+        workers = os.getenv("GRAPH_WORKERS", "1")
+        try:
+            num = int(workers)
+        except ValueError:
+            num = 1
+        num = max(num, 1)
+        _PLOT_POOL = ProcessPoolExecutor(max_workers=num, mp_context=mp.get_context("spawn"))
+    return _PLOT_POOL
 
-        start_ts = data.setdefault("start_ts", time.time())
-        TIMEOUT  = 3 * 60
-        if time.time() - start_ts > TIMEOUT:
-            await ctx.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=msg_id,
-                text="⚠️  Speedtest занял много времени и был прерван.",
-            )
-            job.schedule_removal()
+async def run_plot(func, *args):
+    """Run plotting function in the shared worker process pool."""
+    global _PLOT_POOL
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_plot_pool(), functools.partial(func, *args))
+    except BrokenProcessPool:
+        # процесс упал (например, по памяти) — следующий график создаст новый пул
+        _PLOT_POOL = None
+        raise
+
+# готовые графики кнопок: (функция, аргументы) → (срок годности, JPEG, имя файла).
+# Данные усредняются интервалами bucket_for(span), поэтому в пределах
+# такого интервала повторный рендер даёт почти ту же картинку
+_PLOT_CACHE: "OrderedDict[tuple, tuple[float, bytes, str]]" = OrderedDict()
+PLOT_CACHE_SIZE = 64
+
+async def cached_plot(func, *args) -> io.BytesIO | None:
+    """run_plot с кэшем; последний аргумент функции — промежуток в секундах."""
+    key = (func.__name__, *args)
+    now = time.monotonic()
+    hit = _PLOT_CACHE.get(key)
+    if hit and hit[0] > now:
+        _PLOT_CACHE.move_to_end(key)
+        buf = io.BytesIO(hit[1])
+        buf.name = hit[2]
+        return buf
+    buf = await run_plot(func, *args)
+    if buf is not None:
+        _PLOT_CACHE[key] = (now + bucket_for(args[-1]), buf.getvalue(), buf.name)
+        _PLOT_CACHE.move_to_end(key)
+        while len(_PLOT_CACHE) > PLOT_CACHE_SIZE:
+            _PLOT_CACHE.popitem(last=False)
+    return buf
+
+# ожидание результата speedtest: process_payload будит всех ждущих по ключу,
+# как только от агента приходит текст со словом «Speedtest». Событие
+# регистрируется до отправки команды, чтобы быстрый ответ агента не потерялся
+_SPEEDTEST_EVENTS: Dict[str, asyncio.Event] = {}
+SPEEDTEST_TIMEOUT = 3 * 60
+
+async def await_speedtest(
+    bot, ev: asyncio.Event, secret: str, chat_id: int, msg_id: int
+) -> None:
+    try:
+        await asyncio.wait_for(ev.wait(), SPEEDTEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        if _SPEEDTEST_EVENTS.get(secret) is ev:
+            del _SPEEDTEST_EVENTS[secret]
+        await bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=msg_id,
+            text="⚠️  Speedtest занял много времени и был прерван.",
+        )
         return
 
-    # ─── 3) Результат получен – выкладываем и выходим ───────────────────────────
-    await ctx.bot.edit_message_text(
+    await bot.edit_message_text(
         chat_id=chat_id,
         message_id=msg_id,
-        text=status,
+        text=LATEST_TEXT.get(secret, ""),
         parse_mode="Markdown",
     )
-    job.schedule_removal()
 
 
 async def check_diag_done(ctx: ContextTypes.DEFAULT_TYPE):
@@ -257,11 +318,11 @@ async def check_diag_done(ctx: ContextTypes.DEFAULT_TYPE):
             )
             job.schedule_removal()
         return
-    if result is None:
+    if result is None or result is DIAG_TOO_LARGE:
         await ctx.bot.edit_message_text(
             chat_id=chat_id,
             message_id=msg_id,
-            text="⚠️ Диагностика не удалась.",
+            text=result or "⚠️ Диагностика не удалась.",
         )
         LATEST_DIAG.pop(secret, None)
         job.schedule_removal()
@@ -314,7 +375,7 @@ async def check_status_done(ctx: ContextTypes.DEFAULT_TYPE):
 
 async def _purge_loop():
     while True:
-        purge_old_metrics()
+        await asyncio.to_thread(purge_old_metrics)
         await asyncio.sleep(86400)
 
 
@@ -359,14 +420,122 @@ OWNER_HELP = (
     "/setalert <ключ/имя> <метрика> <порог> – настроить алерт.\n"
     "/delalert <ключ/имя> <метрика> – удалить алерт."
 )
-def gen_secret(n: int = 20):
-    return "".join(secrets.choice(string.ascii_letters + string.digits) for _ in range(n))
+def gen_secret(n: int = 20) -> str:
+    # один вызов CSPRNG; алфавит URL-safe base64 (буквы, цифры, "-" и "_")
+    return secrets.token_urlsafe(n)[:n]
+
+# обратный индекс user_id → ключи (dict как упорядоченное множество);
+# строится из состояния при первом обращении и живёт только в памяти
+_BY_USER: Dict[int, Dict[str, None]] | None = None
+
+def _user_index() -> Dict[int, Dict[str, None]]:
+    global _BY_USER
+    if _BY_USER is None:
+        idx: Dict[int, Dict[str, None]] = {}
+        for s, e in load_db()["secrets"].items():
+            for uid in e.get("owners", []):
+                idx.setdefault(uid, {})[s] = None
+        _BY_USER = idx
+    return _BY_USER
+
+def index_owner(secret: str, user_id: int) -> None:
+    _user_index().setdefault(user_id, {})[secret] = None
+
+def unindex_secret(secret: str, entry: Dict[str, Any]) -> None:
+    idx = _user_index()
+    for uid in entry.get("owners", []):
+        idx.get(uid, {}).pop(secret, None)
+
+def user_secrets(db: Dict[str, Any], user_id: int) -> List[tuple[str, Dict[str, Any]]]:
+    """Ключи пользователя без обхода всех записей."""
+    res = []
+    for s in _user_index().get(user_id, ()):
+        entry = db["secrets"].get(s)
+        if entry is not None:
+            res.append((s, entry))
+    return res
+
+def find_user_secret(db: Dict[str, Any], user_id: int, key: str) -> str | None:
+    """Найти ключ пользователя по полному ключу или названию."""
+    entry = db["secrets"].get(key)
+    if entry and is_owner(entry, user_id):
+        return key
+    for s, e in user_secrets(db, user_id):
+        if e.get("nickname") == key:
+            return s
+    return None
 
 def is_owner(entry: Dict[str, Any], user_id: int) -> bool:
-    return user_id in entry.get("owners", [])
+    # множество владельцев строится один раз и живёт только в памяти
+    owners = entry.get("_owners_set")
+    if owners is None:
+        owners = entry["_owners_set"] = set(entry.get("owners", []))
+    return user_id in owners
 
 from typing import Sequence, Mapping
 
+# Постоянная часть сообщения /status; необязательные блоки (процессы, сеть,
+# GPU, диски) собираются хелперами ниже и начинаются с перевода строки.
+STATUS_TEMPLATE = (
+    "💻 *PC stats*\n"
+    "🕒 Updated: {updated}\n"
+    "⏳ Uptime: {uptime}\n"
+    "*━━━━━━━━━━━CPU━━━━━━━━━━━*\n"
+    "🖥️ CPU: {cpu:.1f}%\n"
+    "🌡️ CPU Temp: {cpu_temp}\n"
+    "*━━━━━━━━━━━RAM━━━━━━━━━━━*\n"
+    "🧠 RAM: {ram_used} / {ram_total} ({ram:.1f}%)\n"
+    "🧠 SWAP: {swap_used} / {swap_total} ({swap:.1f}%)"
+    "{procs_block}{net_block}{gpu_block}{disk_block}"
+)
+
+def _json_list(value: str | list | None) -> list:
+    """Список из отчёта агента (как есть) или из колонки БД (JSON-строка)."""
+    if isinstance(value, str):
+        return orjson.loads(value)
+    return value or []
+
+def _procs_block(top_procs: str | list | None) -> str:
+    procs = _json_list(top_procs)
+    if not procs:
+        return ""
+    return "\n*━━━━━━━━━TOP CPU━━━━━━━━━*" + "".join(
+        f"\n⚙️ {escape_markdown(p.get('name', '')[:20], version=1)}: "
+        f"🖥️ {p['cpu']:.1f}% 🧠 {human_bytes(p['ram'])}"
+        for p in procs
+        if (p.get('name') or '').lower() != 'system idle process'
+    )
+
+def _net_block(net_up: float | None, net_down: float | None) -> str:
+    if net_up is None or net_down is None:
+        return ""
+    return (
+        "\n*━━━━━━━━━━━NET━━━━━━━━━━━*"
+        f"\n📡 Net: ↑ {human_net_speed(net_up)} ↓ {human_net_speed(net_down)}"
+    )
+
+def _gpu_block(gpu, vram, vram_used, vram_total, gpu_temp) -> str:
+    if gpu is None:
+        return ""
+    block = f"\n*━━━━━━━━━━━GPU━━━━━━━━━━━*\n🎮 GPU: {gpu:.1f}%"
+    if vram_used is not None:
+        block += f"\n🗄️ VRAM: {vram_used:.0f} / {vram_total:.0f} MiB ({vram:.1f}%)"
+    if gpu_temp is not None:
+        block += f"\n🌡️ GPU Temp: {gpu_temp:.0f} °C"
+    return block
+
+def _disk_block(disks: str | list | None) -> str:
+    disks = _json_list(disks)
+    if not disks:
+        return ""
+    return "\n*━━━━━━━━━━━DISKS━━━━━━━━━━*" + "".join(
+        f"\n💾 {escape_markdown(d['mount'], version=1)}: {disk_bar(d['percent'])} "
+        f"{d['percent']:.0f}% ({human_bytes(d['used'])} / {human_bytes(d['total'])})"
+        f"{'❗' if d['percent'] >= 90 else ''}"
+        for d in disks
+    )
+
+
 # ``format_status`` accepts either a DB row (tuple) or a mapping returned
 # by the agent in ``oneshot`` mode.  The column order for tuples matches the
 # table schema, while dicts use keys.
@@ -412,60 +581,26 @@ def format_status(row: Sequence[Any] | Mapping[str, Any]) -> str:
         disks = row[18]
         top_procs = row[19]
 
-    lines = [
-        "💻 *PC stats*",
-        f"🕒 Updated: {datetime.fromtimestamp(ts).strftime('%d.%m %H:%M:%S')}",
-        f"⏳ Uptime: {timedelta(seconds=int(uptime or 0))}",
-        "*━━━━━━━━━━━CPU━━━━━━━━━━━*",
-        f"🖥️ CPU: {cpu:.1f}%",
-        f"🌡️ CPU Temp: {cpu_temp:.1f} °C" if cpu_temp is not None else "🌡️ CPU Temp: N/A",
-        "*━━━━━━━━━━━RAM━━━━━━━━━━━*",
-        f"🧠 RAM: {human_bytes(ram_used)} / {human_bytes(ram_total)} ({ram:.1f}%)",
-        f"🧠 SWAP: {human_bytes(swap_used)} / {human_bytes(swap_total)} ({swap:.1f}%)",
-    ]
-    procs = json.loads(top_procs) if top_procs else []
-    if procs:
-        lines.append("*━━━━━━━━━TOP CPU━━━━━━━━━*")
-        for p in procs:
-            name_raw = p.get('name', '')
-            if name_raw and name_raw.lower() == 'system idle process':
-                continue
-            name = escape_markdown(name_raw[:20], version=1)
-            lines.append(
-                f"⚙️ {name}: 🖥️ {p['cpu']:.1f}% 🧠 {human_bytes(p['ram'])}"
-            )
-    if net_up is not None and net_down is not None:
-        lines.extend([
-            "*━━━━━━━━━━━NET━━━━━━━━━━━*",
-            f"📡 Net: ↑ {human_net_speed(net_up)} ↓ {human_net_speed(net_down)}",
-        ])
-    if gpu is not None:
-        lines.extend([
-            "*━━━━━━━━━━━GPU━━━━━━━━━━━*",
-            f"🎮 GPU: {gpu:.1f}%",
-        ])
-        if vram_used is not None:
-            lines.append(
-                f"🗄️ VRAM: {vram_used:.0f} / {vram_total:.0f} MiB ({vram:.1f}%)"
-            )
-        if gpu_temp is not None:
-            lines.append(f"🌡️ GPU Temp: {gpu_temp:.0f} °C")
-
-    disks = json.loads(disks) if disks else []
-    if disks:
-        lines.append("*━━━━━━━━━━━DISKS━━━━━━━━━━*")
-        for d in disks:
-            mount = escape_markdown(d['mount'], version=1)
-            line = (
-                f"💾 {mount}: {disk_bar(d['percent'])} "
-                f"{d['percent']:.0f}% ({human_bytes(d['used'])} / {human_bytes(d['total'])})"
-            )
-            if d['percent'] >= 90:
-                line += "❗"
-            lines.append(line)
-    return "\n".join(lines)
+    return STATUS_TEMPLATE.format(
+        updated=datetime.fromtimestamp(ts).strftime('%d.%m %H:%M:%S'),
+        uptime=timedelta(seconds=int(uptime or 0)),
+        cpu=cpu,
+        cpu_temp=f"{cpu_temp:.1f} °C" if cpu_temp is not None else "N/A",
+        ram=ram,
+        ram_used=human_bytes(ram_used),
+        ram_total=human_bytes(ram_total),
+        swap=swap,
+        swap_used=human_bytes(swap_used),
+        swap_total=human_bytes(swap_total),
+        procs_block=_procs_block(top_procs),
+        net_block=_net_block(net_up, net_down),
+        gpu_block=_gpu_block(gpu, vram, vram_used, vram_total, gpu_temp),
+        disk_block=_disk_block(disks),
+    )
 
 # ───────────────────────- UI helpers ───────────────────────────────────────
+# клавиатура неизменяема и зависит только от ключа — собираем один раз
+@functools.lru_cache(maxsize=1024)
 def status_keyboard(secret: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -498,14 +633,14 @@ async def cmd_newkey(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if ctx.args:
         name = " ".join(ctx.args)[:30]
         # проверяем уникальность имени
-        for e in db["secrets"].values():
-            if is_owner(e, uid) and e.get("nickname") == name:
+        for _, e in user_secrets(db, uid):
+            if e.get("nickname") == name:
                 return await update.message.reply_text("❌ Имя уже занято.")
     else:
         base = "key"
         nums = []
-        for e in db["secrets"].values():
-            if is_owner(e, uid) and (n := e.get("nickname")) and n.startswith(base):
+        for _, e in user_secrets(db, uid):
+            if (n := e.get("nickname")) and n.startswith(base):
                 tail = n[len(base):]
                 if tail.isdigit():
                     nums.append(int(tail))
@@ -518,8 +653,9 @@ async def cmd_newkey(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     db["secrets"][secret] = {
         "owners": [uid],
         "nickname": name,
-        "pending": [],
+        "pending": deque(),
     }
+    index_owner(secret, uid)
     db["active"][str(update.effective_chat.id)] = secret
     save_db(db)
     await update.message.reply_text(
@@ -534,9 +670,11 @@ async def cmd_linkkey(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     entry = db["secrets"].get(secret)
     if not entry:
         return await update.message.reply_text("🚫 Ключ не найден.")
-    if update.effective_user.id in entry["owners"]:
+    if is_owner(entry, update.effective_user.id):
         return await update.message.reply_text("✔️ Уже есть доступ.")
     entry["owners"].append(update.effective_user.id)
+    entry["_owners_set"].add(update.effective_user.id)
+    index_owner(secret, update.effective_user.id)
     db["active"][str(update.effective_chat.id)] = secret
     save_db(db)
     await update.message.reply_text("✅ Ключ добавлен и сделан активным.")
@@ -553,40 +691,31 @@ async def cmd_setactive(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     save_db(db)
     await update.message.reply_text(f"✅ Активный: `{secret}`", parse_mode="Markdown")
 
+def fmt_uptime(up: int | None) -> str:
+    """Аптайм из последней строки metrics (latest_metrics) для списка ключей."""
+    return "-" if up is None else str(timedelta(seconds=int(up)))
+
 async def cmd_list(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     db   = load_db()
     uid  = update.effective_user.id
     now  = int(time.time())
 
     rows = []
-    for secret, entry in db["secrets"].items():
-        if not is_owner(entry, uid):
-            continue
-
+    keys = user_secrets(db, uid)
+    latest = await asyncio.to_thread(latest_metrics, [s for s, _ in keys])
+    for secret, entry in keys:
         name = entry.get("nickname") or secret
 
-        row = sql.execute(
-            "SELECT ts, cpu, ram FROM metrics "
-            "WHERE secret=? ORDER BY ts DESC LIMIT 1",
-            (secret,),
-        ).fetchone()
-
+        row = latest.get(secret)
         if row:
-            ts, cpu, ram = row
+            ts, cpu, ram, up = row
             fresh = (now - ts) < 300
             info  = f"🖥️{cpu:.0f}% CPU, 🧠{ram:.0f}% RAM"
+            uptime = fmt_uptime(up)
         else:
             fresh = False
             info  = "нет данных"
-
-        uptime = "-"
-        if row:
-            up = sql.execute(
-                "SELECT uptime FROM metrics WHERE secret=? ORDER BY ts DESC LIMIT 1",
-                (secret,),
-            ).fetchone()
-            if up and up[0] is not None:
-                uptime = str(timedelta(seconds=int(up[0])))
+            uptime = "-"
 
         marker = " <b>❗️ДАННЫЕ УСТАРЕЛИ❗</b>" if not fresh else ""
         rows.append(
@@ -600,8 +729,7 @@ async def cmd_list(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             entry.get("nickname") or s,
             callback_data=f"status:{s}",
         )
-        for s, entry in list(db["secrets"].items())[:12]
-        if is_owner(entry, uid)
+        for s, entry in user_secrets(db, uid)[:12]
     ]
     keyboard = InlineKeyboardMarkup([buttons[i:i + 4] for i in range(0, len(buttons), 4)])
 
@@ -616,8 +744,7 @@ async def cmd_list(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         reply_markup=keyboard,
     )
 
-def resolve_secret(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> str | None:
-    db = load_db()
+def resolve_secret(update: Update, ctx: ContextTypes.DEFAULT_TYPE, db: Dict[str, Any]) -> str | None:
     secret = ctx.args[0] if ctx.args else db["active"].get(str(update.effective_chat.id))
     entry = db["secrets"].get(secret) if secret else None
     if not entry or not is_owner(entry, update.effective_user.id):
@@ -633,8 +760,8 @@ async def cmd_renamekey(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not entry or not is_owner(entry, update.effective_user.id):
         return await update.message.reply_text("🚫 Нет доступа.")
     uid = update.effective_user.id
-    for s, e in db["secrets"].items():
-        if s != secret and is_owner(e, uid) and e.get("nickname") == new_name:
+    for s, e in user_secrets(db, uid):
+        if s != secret and e.get("nickname") == new_name:
             return await update.message.reply_text("❌ Имя уже занято.")
     entry["nickname"] = new_name
     save_db(db)
@@ -654,34 +781,28 @@ async def cmd_delkey(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             return await update.message.reply_text("🚫 Нет доступа.")
         secret = arg
     else:
-        matches = [s for s, e in db["secrets"].items() if is_owner(e, uid) and e.get("nickname") == arg]
+        matches = [s for s, e in user_secrets(db, uid) if e.get("nickname") == arg]
         if not matches:
             return await update.message.reply_text("Ключ не найден.")
         if len(matches) > 1:
             return await update.message.reply_text("Несколько ключей с таким именем. Укажи полный ключ.")
         secret = matches[0]
 
-    db["secrets"].pop(secret, None)
+    unindex_secret(secret, db["secrets"].pop(secret, {}))
     for chat, s in list(db["active"].items()):
         if s == secret:
             db["active"].pop(chat)
     save_db(db)
-    sql.execute("DELETE FROM metrics WHERE secret=?", (secret,))
+    await asyncio.to_thread(delete_metrics, secret)
     LATEST_TEXT.pop(secret, None)
     await update.message.reply_text(f"🗑️ Удалён ключ {secret}")
 
 async def cmd_status(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    secret = resolve_secret(update, ctx)
+    db = load_db()
+    secret = resolve_secret(update, ctx, db)
     if not secret:
         return await update.message.reply_text("Нет доступа или активного ключа.")
-    db = load_db()
-    entry = db["secrets"].get(secret)
-    if not entry or not is_owner(entry, update.effective_user.id):
-        return await update.message.reply_text("🚫 Нет доступа.")
-    row = sql.execute(
-        "SELECT * FROM metrics WHERE secret=? ORDER BY ts DESC LIMIT 1",
-        (secret,),
-    ).fetchone()
+    row = await asyncio.to_thread(latest_row, secret)
 
     if row:
         msg = await update.message.reply_text(
@@ -722,15 +843,7 @@ async def cmd_setalert(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     db = load_db()
     uid = str(update.effective_user.id)
 
-    secret = None
-    entry = db["secrets"].get(key)
-    if entry and is_owner(entry, update.effective_user.id):
-        secret = key
-    else:
-        for s, e in db["secrets"].items():
-            if is_owner(e, update.effective_user.id) and e.get("nickname") == key:
-                secret = s
-                break
+    secret = find_user_secret(db, update.effective_user.id, key)
     if not secret:
         return await update.message.reply_text("Ключ не найден.")
 
@@ -757,15 +870,7 @@ async def cmd_delalert(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     db = load_db()
     uid = str(update.effective_user.id)
 
-    secret = None
-    entry = db["secrets"].get(key)
-    if entry and is_owner(entry, update.effective_user.id):
-        secret = key
-    else:
-        for s, e in db["secrets"].items():
-            if is_owner(e, update.effective_user.id) and e.get("nickname") == key:
-                secret = s
-                break
+    secret = find_user_secret(db, update.effective_user.id, key)
     if not secret:
         return await update.message.reply_text("Ключ не найден.")
 
@@ -822,15 +927,7 @@ async def cmd_plot(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     db = load_db()
     uid = update.effective_user.id
-    secret = None
-    entry = db["secrets"].get(key)
-    if entry and is_owner(entry, uid):
-        secret = key
-    else:
-        for s, e in db["secrets"].items():
-            if is_owner(e, uid) and e.get("nickname") == key:
-                secret = s
-                break
+    secret = find_user_secret(db, uid, key)
     if not secret:
         return await update.message.reply_text("Ключ не найден.")
 
@@ -842,13 +939,8 @@ async def cmd_plot(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("Данных за этот период нет.")
 
     caption = f"{'/'.join([m.upper() for m in metrics])} за {timedelta(seconds=seconds)}"
-    if seconds >= 86400:
-        doc = InputFile(buf, filename="plot.png")
-        await ctx.bot.send_document(chat_id=update.effective_chat.id, document=doc, caption=caption)
-        buf.close()
-    else:
-        await ctx.bot.send_photo(chat_id=update.effective_chat.id, photo=buf, caption=caption)
-        buf.close()
+    await ctx.bot.send_photo(chat_id=update.effective_chat.id, photo=buf, caption=caption)
+    buf.close()
 
 
 # ─────────────────────- Callback handler ───────────────────────────────────
@@ -868,10 +960,7 @@ async def cb_action(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         if not entry or not is_owner(entry, q.from_user.id):
             return await q.edit_message_text("🚫 Нет доступа.")
 
-        row = sql.execute(
-            "SELECT * FROM metrics WHERE secret=? ORDER BY ts DESC LIMIT 1",
-            (secret,),
-        ).fetchone()
+        row = await asyncio.to_thread(latest_row, secret)
 
         orig = q.message.text or ""
         prefixes = ("💻", "⏳", "Нет данных", "⚠️")
@@ -915,34 +1004,23 @@ async def cb_action(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         uid = q.from_user.id
         now = int(time.time())
         rows = []
+        keys = user_secrets(db, uid)
+        latest = await asyncio.to_thread(latest_metrics, [s for s, _ in keys])
 
-        for secret, entry in db["secrets"].items():
-            if not is_owner(entry, uid):
-                continue
-
+        for secret, entry in keys:
             name = entry.get("nickname") or secret
 
-            row = sql.execute(
-                "SELECT ts, cpu, ram FROM metrics "
-                "WHERE secret=? ORDER BY ts DESC LIMIT 1",
-                (secret,),
-            ).fetchone()
-
+            row = latest.get(secret)
             if row:
-                ts, cpu, ram = row
+                ts, cpu, ram, up = row
                 fresh = (now - ts) < 300
                 info = f"🖥️{cpu:.0f}% CPU, 🧠{ram:.0f}% RAM"
             else:
                 fresh = False
                 info = "нет данных"
+                up = None
 
-            uptime = "-"
-            up = sql.execute(
-                "SELECT uptime FROM metrics WHERE secret=? ORDER BY ts DESC LIMIT 1",
-                (secret,),
-            ).fetchone()
-            if up and up[0] is not None:
-                uptime = str(timedelta(seconds=int(up[0])))
+            uptime = fmt_uptime(up)
 
             marker = " <b>❗️ДАННЫЕ УСТАРЕЛИ❗</b>" if not fresh else ""
             rows.append(
@@ -956,8 +1034,7 @@ async def cb_action(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 entry.get("nickname") or s,
                 callback_data=f"status:{s}",
             )
-            for s, entry in db["secrets"].items()
-            if is_owner(entry, uid)
+            for s, entry in user_secrets(db, uid)
         ]
         keyboard = InlineKeyboardMarkup(
             [buttons[i:i + 4] for i in range(0, len(buttons), 4)]
@@ -983,6 +1060,7 @@ async def cb_action(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         if not entry or not is_owner(entry, q.from_user.id):
             await q.answer("🚫 Нет доступа.", show_alert=True)
             return
+        ev = _SPEEDTEST_EVENTS.setdefault(secret, asyncio.Event())
         await send_or_queue(secret, "speedtest")
 
         await q.answer()
@@ -991,14 +1069,8 @@ async def cb_action(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             text="⏳ Тестируем скорость…"
         )
 
-        ctx.job_queue.run_repeating(
-            callback=check_speedtest_done,
-            interval=3,
-            data={
-                "secret": secret,
-                "chat_id": msg.chat_id,
-                "msg_id": msg.message_id,
-            },
+        ctx.application.create_task(
+            await_speedtest(ctx.bot, ev, secret, msg.chat_id, msg.message_id)
         )
         return
 
@@ -1051,138 +1123,210 @@ async def cb_action(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         secret = parts[3]
 
         if metric == "all":
-            buf = await run_plot(plot_all_metrics, secret, seconds)
+            buf = await cached_plot(plot_all_metrics, secret, seconds)
             caption = f"Все метрики за {timedelta(seconds=seconds)}"
         elif metric == "net":
-            buf = await run_plot(plot_net, secret, seconds)
+            buf = await cached_plot(plot_net, secret, seconds)
             caption = f"NET за {timedelta(seconds=seconds)}"
         else:
-            buf = await run_plot(plot_metric, secret, metric, seconds)
+            buf = await cached_plot(plot_metric, secret, metric, seconds)
             caption = f"{metric.upper()} за {timedelta(seconds=seconds)}"
 
         if not buf:
             return await q.edit_message_text("Данных за этот период нет.")
 
         caption = f"{metric.upper()} за {timedelta(seconds=seconds)}"
-        if seconds >= 86400:
-            doc = InputFile(buf, filename=f"{metric}_{seconds}.png")
-            await ctx.bot.send_document(
-                chat_id=q.message.chat_id,
-                document=doc,
-                caption=caption,
-            )
-            buf.close()
-        else:
-            await ctx.bot.send_photo(
-                chat_id=q.message.chat_id,
-                photo=buf,
-                caption=caption,
-            )
-            buf.close()
+        await ctx.bot.send_photo(
+            chat_id=q.message.chat_id,
+            photo=buf,
+            caption=caption,
+        )
+        buf.close()
         return
 
 # ────────────────────────── FastAPI for agents ─────────────────────────────
 app = FastAPI()
 
-class PushPayload(BaseModel):
-    cpu: float | None = None
-    ram: float | None = None
-    ram_used: float | None = None
-    ram_total: float | None = None
-    swap: float | None = None
-    swap_used: float | None = None
-    swap_total: float | None = None
-    gpu: float | None = None
-    vram: float | None = None
-    vram_used: float | None = None
-    vram_total: float | None = None
-    cpu_temp: float | None = None
-    gpu_temp: float | None = None
-    net_up: float | None = None
-    net_down: float | None = None
-    uptime: int | None = None
-    disks: list[dict] | None = None
-    top_procs: list[dict] | None = None
-    oneshot: bool | None = None
-    text: str | None = None
-    diag: str | None = None
-    diag_ok: bool | None = None
-
-
-async def process_payload(secret: str, payload: PushPayload) -> None:
+# текст статуса уходит в сообщение Telegram (лимит 4096 символов) и
+# обрезается; диагностика — файлом, слишком большая заменяется DIAG_TOO_LARGE
+MAX_TEXT_LEN = 4096
+MAX_DIAG_LEN = 1 << 20
+DIAG_TOO_LARGE = "⚠️ Отчёт диагностики слишком большой, сервер его отбросил."
+
+_NUM = (int, float)
+# поля сообщения агента и допустимые типы значений (None разрешён всегда)
+PAYLOAD_FIELDS: Dict[str, Any] = {
+    "cpu": _NUM,
+    "ram": _NUM,
+    "ram_used": _NUM,
+    "ram_total": _NUM,
+    "swap": _NUM,
+    "swap_used": _NUM,
+    "swap_total": _NUM,
+    "gpu": _NUM,
+    "vram": _NUM,
+    "vram_used": _NUM,
+    "vram_total": _NUM,
+    "cpu_temp": _NUM,
+    "gpu_temp": _NUM,
+    "net_up": _NUM,
+    "net_down": _NUM,
+    "uptime": int,
+    "disks": list,
+    "top_procs": list,
+    "oneshot": bool,
+    "text": str,
+    "diag": str,
+    "diag_ok": bool,
+}
+
+
+def parse_payload(raw: str | bytes) -> Dict[str, Any] | None:
+    """Разобрать сообщение агента без Pydantic.
+
+    Возвращает словарь со всеми полями PAYLOAD_FIELDS (отсутствующие — None),
+    неизвестные ключи отбрасываются. None — если сообщение некорректно.
+    Длинные text/diag не отбрасывают сообщение целиком: метрики в нём
+    остаются, а пользователь получает обрезанный текст или DIAG_TOO_LARGE.
+    """
+    try:
+        obj = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return None
+    if not isinstance(obj, dict):
+        return None
+    data = dict.fromkeys(PAYLOAD_FIELDS)
+    for key, val in obj.items():
+        types = PAYLOAD_FIELDS.get(key)
+        if types is None or val is None:
+            continue
+        # bool — подкласс int, в числовые поля его не пускаем
+        if not isinstance(val, types) or (isinstance(val, bool) and types is not bool):
+            return None
+        if key == "text" and len(val) > MAX_TEXT_LEN:
+            val = val[:MAX_TEXT_LEN]
+        elif key == "diag" and len(val) > MAX_DIAG_LEN:
+            val = DIAG_TOO_LARGE
+        data[key] = val
+    return data
+
+
+async def process_payload(secret: str, data: Dict[str, Any]) -> None:
     """Обработать данные от агента."""
-    db = load_db()
-    if secret not in db["secrets"]:
+    if secret not in _SECRETS:
         raise HTTPException(404)
 
-    if payload.text:
-        LATEST_TEXT[secret] = payload.text
+    if data["text"]:
+        LATEST_TEXT[secret] = data["text"]
+        if "Speedtest" in data["text"] and (ev := _SPEEDTEST_EVENTS.pop(secret, None)):
+            ev.set()
 
-    if payload.diag_ok is not None:
-        LATEST_DIAG[secret] = payload.diag if payload.diag_ok else None
+    if data["diag_ok"] is not None:
+        LATEST_DIAG[secret] = data["diag"] if data["diag_ok"] else None
         return
 
-    if payload.cpu is None or payload.ram is None:
+    if data["cpu"] is None or data["ram"] is None:
         return
 
-    if payload.oneshot:
-        data = payload.model_dump()
-        data.pop("oneshot", None)
-        data["disks"] = json.dumps(data.get("disks") or [])
-        data["top_procs"] = json.dumps(data.get("top_procs") or [])
+    if data.pop("oneshot"):
         data["ts"] = int(time.time())
         LATEST_STATUS[secret] = data
         await maybe_send_alerts(secret, data)
         return
 
-    record_metric(secret, payload.model_dump())
-    await maybe_send_alerts(secret, payload.model_dump())
+    # только буферизация; вставка в MySQL идёт пачками в фоновом потоке
+    record_metric(secret, data)
+    await maybe_send_alerts(secret, data)
+
 
 
 
 
+def _take_pending(secret: str) -> list[str]:
+    """Забрать команды из очереди; пустую очередь не трогаем и не сохраняем."""
+    entry = _SECRETS.get(secret)
+    queue = entry.get("pending") if entry else None
+    if not queue:
+        return []
+    cmds = list(queue)
+    queue.clear()
+    save_db(load_db())
+    return cmds
 
 @app.websocket("/ws/{secret}")
 async def ws_endpoint(ws: WebSocket, secret: str):
-    db = load_db()
-    if secret not in db["secrets"]:
+    if secret not in _SECRETS:
         await ws.close(code=1008)
         return
     await ws.accept()
     ACTIVE_WS[secret] = ws
     try:
+        # команды, накопленные пока агент был офлайн, отдаём сразу,
+        # не дожидаясь первой порции метрик
+        if cmds := _take_pending(secret):
+            await ws_send_json(ws, {"commands": cmds})
         while True:
-            data = await ws.receive_json()
-            await process_payload(secret, PushPayload(**data))
-            db = load_db()
-            cmds = db["secrets"][secret].get("pending", [])
-            db["secrets"][secret]["pending"] = []
-            save_db(db)
-            await ws.send_json({"commands": cmds})
+            data = parse_payload(await ws.receive_text())
+            if data is None:
+                log.warning("Bad payload from %s…", secret[:6])
+                continue
+            await process_payload(secret, data)
+            # агент читает команды отдельной задачей, пустой ответ ему не нужен
+            if cmds := _take_pending(secret):
+                await ws_send_json(ws, {"commands": cmds})
     except WebSocketDisconnect:
         pass
     finally:
         ACTIVE_WS.pop(secret, None)
 
 # ────────────────────────── Bootstrap ──────────────────────────────────────
-def start_uvicorn():
-    kwargs = dict(host="0.0.0.0", port=API_PORT, log_level="info")
+def _uvicorn_config() -> uvicorn.Config:
+    # uvloop + httptools входят в uvicorn[standard]; uvloop нет под Windows.
+    # access-лог на каждое сообщение агента только тратит CPU
+    kwargs = dict(
+        host="0.0.0.0",
+        port=API_PORT,
+        log_level="info",
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        access_log=False,
+    )
     if CERT_FILE.exists() and KEY_FILE.exists():
         kwargs.update(ssl_certfile=str(CERT_FILE), ssl_keyfile=str(KEY_FILE))
         log.info("🔐 TLS enabled.")
     else:
         log.warning("⚠️  TLS disabled.")
-    uvicorn.run(app, **kwargs)
+    return uvicorn.Config(app, **kwargs)
+
+async def _serve(server: uvicorn.Server) -> None:
+    """FastAPI и Telegram-бот на одном event loop."""
+    async with TG_APP:
+        await TG_APP.start()
+        await TG_APP.updater.start_polling(allowed_updates=["message", "callback_query"])
+        TG_APP.create_task(_purge_loop())
+        log.info("🤖 Polling…")
+        log.info("🌐 FastAPI on port %s", API_PORT)
+        try:
+            # serve() сам ловит SIGINT/SIGTERM и возвращается по ним
+            await server.serve()
+        finally:
+            await TG_APP.updater.stop()
+            await TG_APP.stop()
 
 def main():
-    threading.Thread(target=start_uvicorn, daemon=True).start()
-    log.info("🌐 FastAPI on port %s", API_PORT)
-
     global TG_APP
-    async def post_init(app: Application) -> None:
-        app.create_task(_purge_loop())
-
-    TG_APP = ApplicationBuilder().token(TOKEN).post_init(post_init).build()
+    # несколько апдейтов обрабатываются параллельно (графики, speedtest),
+    # поэтому и соединений с Bot API нужно больше одного
+    TG_APP = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .connection_pool_size(64)
+        .pool_timeout(10)
+        .read_timeout(20)
+        .get_updates_connection_pool_size(4)
+        .concurrent_updates(True)
+        .build()
+    )
     TG_APP.add_handler(CommandHandler(["start", "help"], cmd_start))
     TG_APP.add_handler(CommandHandler("newkey", cmd_newkey))
     TG_APP.add_handler(CommandHandler("linkkey", cmd_linkkey))
@@ -1199,8 +1343,10 @@ def main():
     # очищаем старые метрики и запускаем периодическую уборку
     purge_old_metrics()
 
-    log.info("🤖 Polling…")
-    TG_APP.run_polling(allowed_updates=["message", "callback_query"])
+    config = _uvicorn_config()
+    # как uvicorn.run(): политика loop (uvloop) ставится до asyncio.run
+    config.setup_event_loop()
+    asyncio.run(_serve(uvicorn.Server(config)))
 
 if __name__ == "__main__":
     try:
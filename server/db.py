@@ -1,20 +1,49 @@
 """Database helpers using MySQL backend with automatic migration."""
 from __future__ import annotations
 
+import atexit
+import functools
 import json
+import logging
 import os
 import sqlite3
 import threading
 import time
+from collections import deque
 from pathlib import Path
 from typing import Any, Dict, List
 
+import numpy as np
+import orjson
 import pymysql
 
+log = logging.getLogger(__name__)
+
 DB_FILE = Path("db.json")
 METRIC_DB = Path("metrics.sqlite")
 
 
+@functools.lru_cache(maxsize=256)
+def _paramstyle(query: str) -> str:
+    """Плейсхолдеры sqlite (?) → pymysql (%s); запросы — константы, кэш попадает."""
+    return query.replace("?", "%s")
+
+
+class _Res:
+    """Лёгкий результат запроса с интерфейсом курсора sqlite."""
+
+    __slots__ = ("_rows",)
+
+    def __init__(self, rows):
+        self._rows = rows
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+
 class MySQL:
     def __init__(self) -> None:
         host = os.getenv("MYSQL_HOST", "127.0.0.1")
@@ -44,19 +73,12 @@ class MySQL:
 
     def execute(self, query: str, params: tuple | None = None):
         """Execute a query and return a lightweight result object."""
-        query = query.replace("?", "%s")
+        query = _paramstyle(query)
         with self.lock:
             cur = self.conn.cursor()
             cur.execute(query, params or ())
             rows = cur.fetchall() if cur.description else []
             cur.close()
-        class _Res:
-            def __init__(self, r):
-                self._rows = r
-            def fetchone(self):
-                return self._rows[0] if self._rows else None
-            def fetchall(self):
-                return self._rows
         return _Res(rows)
 
     def _init_schema(self) -> None:
@@ -97,6 +119,14 @@ class MySQL:
             except Exception:
                 pass
             cur.execute("INSERT IGNORE INTO state(id, data) VALUES(1, '{}')")
+            # записи ключей хранятся построчно, чтобы изменение одного ключа
+            # не переписывало всё состояние
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS secrets(
+                       secret  VARCHAR(255) PRIMARY KEY,
+                       data    MEDIUMTEXT
+                   )"""
+            )
 
     def _maybe_migrate(self) -> None:
         migrated = False
@@ -132,140 +162,353 @@ class MySQL:
 sql = MySQL()
 
 
+_PURGE_SQL = "DELETE FROM metrics WHERE ts < %s"
+_LATEST_ROW_SQL = "SELECT * FROM metrics WHERE secret=%s ORDER BY ts DESC LIMIT 1"
+_DELETE_SECRET_SQL = "DELETE FROM metrics WHERE secret=%s"
+
+
 def purge_old_metrics(days: int = 30) -> None:
     cutoff = int(time.time()) - days * 86400
     with sql.lock, sql.conn.cursor() as cur:
-        cur.execute("DELETE FROM metrics WHERE ts < %s", (cutoff,))
+        cur.execute(_PURGE_SQL, (cutoff,))
+
+
+def latest_row(secret: str) -> tuple | None:
+    """Последняя строка metrics ключа (все колонки)."""
+    with sql.lock, sql.conn.cursor() as cur:
+        cur.execute(_LATEST_ROW_SQL, (secret,))
+        return cur.fetchone()
+
+
+def delete_metrics(secret: str) -> None:
+    """Удалить метрики ключа, включая ещё не записанные из буфера."""
+    with sql.lock:
+        with _metric_lock:
+            rest = [r for r in _metric_buf if r[0] != secret]
+            _metric_buf.clear()
+            _metric_buf.extend(rest)
+        with sql.conn.cursor() as cur:
+            cur.execute(_DELETE_SECRET_SQL, (secret,))
+
+
+_METRIC_INSERT = """INSERT INTO metrics(
+       secret, ts, cpu, ram, gpu, vram,
+       ram_used, ram_total, swap, swap_used, swap_total,
+       vram_used, vram_total, cpu_temp, gpu_temp,
+       net_up, net_down, uptime, disks, top_procs
+   ) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"""
+
+# Пакетная запись метрик: record_metric только кладёт строку в буфер,
+# а фоновый поток раз в METRIC_FLUSH_SEC (или сразу при METRIC_BATCH строках)
+# вставляет накопленное одним executemany. Буфер ограничен, чтобы при
+# недоступном MySQL не расти бесконечно.
+METRIC_FLUSH_SEC = 0.5
+METRIC_BATCH = 1000
+_metric_buf: deque[tuple] = deque(maxlen=100_000)
+_metric_lock = threading.Lock()
+_metric_full = threading.Event()
+_flusher: threading.Thread | None = None
+
+
+def flush_metrics() -> None:
+    """Записать буфер метрик.
+
+    Пачку, отвергнутую сервером из-за данных, отбрасываем — иначе она
+    навсегда заблокирует запись. При ошибке соединения строки возвращаются
+    в начало буфера, но только на свободное место, чтобы не вытеснить новые.
+    sql.lock берётся до выемки из буфера: delete_metrics не разминётся
+    с пачкой, уже вынутой, но ещё не вставленной.
+    """
+    with sql.lock:
+        with _metric_lock:
+            if not _metric_buf:
+                return
+            rows = list(_metric_buf)
+            _metric_buf.clear()
+        try:
+            with sql.conn.cursor() as cur:
+                cur.executemany(_METRIC_INSERT, rows)
+        except (pymysql.DataError, pymysql.IntegrityError) as exc:
+            log.error("metrics batch of %d rows rejected, dropped: %s", len(rows), exc)
+        except Exception:
+            with _metric_lock:
+                room = _metric_buf.maxlen - len(_metric_buf)
+                if room > 0:
+                    _metric_buf.extendleft(reversed(rows[-room:]))
+            raise
+
+
+def _flusher_loop() -> None:
+    while True:
+        _metric_full.wait(METRIC_FLUSH_SEC)
+        _metric_full.clear()
+        try:
+            flush_metrics()
+        except Exception as exc:
+            log.warning("metrics flush failed: %s", exc)
+            time.sleep(1)
 
 
 def record_metric(secret: str, data: Dict[str, Any]) -> None:
+    global _flusher
+    row = (
+        secret,
+        int(time.time()),
+        data.get("cpu"),
+        data.get("ram"),
+        data.get("gpu"),
+        data.get("vram"),
+        data.get("ram_used"),
+        data.get("ram_total"),
+        data.get("swap"),
+        data.get("swap_used"),
+        data.get("swap_total"),
+        data.get("vram_used"),
+        data.get("vram_total"),
+        data.get("cpu_temp"),
+        data.get("gpu_temp"),
+        data.get("net_up"),
+        data.get("net_down"),
+        data.get("uptime"),
+        None,
+        None,
+    )
+    with _metric_lock:
+        _metric_buf.append(row)
+        full = len(_metric_buf) >= METRIC_BATCH
+    if full:
+        _metric_full.set()
+    if _flusher is None:
+        with _metric_lock:
+            if _flusher is None:
+                _flusher = threading.Thread(target=_flusher_loop, name="metrics-writer", daemon=True)
+                _flusher.start()
+
+
+atexit.register(flush_metrics)
+
+
+def latest_metrics(secrets: List[str]) -> Dict[str, tuple]:
+    """Последняя строка (ts, cpu, ram, uptime) для каждого ключа одним запросом."""
+    if not secrets:
+        return {}
+    marks = ",".join(["%s"] * len(secrets))
     with sql.lock, sql.conn.cursor() as cur:
         cur.execute(
-            """INSERT INTO metrics(
-                   secret, ts, cpu, ram, gpu, vram,
-                   ram_used, ram_total, swap, swap_used, swap_total,
-                   vram_used, vram_total, cpu_temp, gpu_temp,
-                   net_up, net_down, uptime, disks, top_procs
-               ) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-            (
-                secret,
-                int(time.time()),
-                data.get("cpu"),
-                data.get("ram"),
-                data.get("gpu"),
-                data.get("vram"),
-                data.get("ram_used"),
-                data.get("ram_total"),
-                data.get("swap"),
-                data.get("swap_used"),
-                data.get("swap_total"),
-                data.get("vram_used"),
-                data.get("vram_total"),
-                data.get("cpu_temp"),
-                data.get("gpu_temp"),
-                data.get("net_up"),
-                data.get("net_down"),
-                data.get("uptime"),
-                None,
-                None,
-            ),
+            f"""SELECT m.secret, m.ts, m.cpu, m.ram, m.uptime
+                FROM metrics m
+                JOIN (SELECT secret, MAX(ts) AS ts FROM metrics
+                      WHERE secret IN ({marks}) GROUP BY secret) l
+                  ON m.secret = l.secret AND m.ts = l.ts""",
+            tuple(secrets),
         )
+        rows = cur.fetchall()
+    return {r[0]: r[1:] for r in rows}
 
 
-def _avg(vals: List[float | None]) -> float | None:
-    vals = [v for v in vals if v is not None]
-    return sum(vals) / len(vals) if vals else None
-
+def bucket_for(span: int) -> int:
+    """Ширина интервала усреднения (сек) для графика за span секунд.
 
-def _avg_chunk(chunk: List[tuple]) -> tuple[int, float | None, float | None, float | None, float | None, float | None, float | None]:
-    ts = chunk[-1][0]
-    cpu = _avg([r[1] for r in chunk])
-    ram = _avg([r[2] for r in chunk])
-    gpu = _avg([r[3] for r in chunk])
-    vram = _avg([r[4] for r in chunk])
-    up = _avg([r[5] for r in chunk])
-    down = _avg([r[6] for r in chunk])
-    return ts, cpu, ram, gpu, vram, up, down
+    Около 8000 строк на график, но не мельче 30 с (≈6 отчётов агента);
+    до экранного разрешения ряд прореживает LTTB уже при отрисовке,
+    сохраняя пики, которые среднее по крупным интервалам сгладило бы.
+    """
+    return max(30, span // 8000)
 
 
-def fetch_metrics(secret: str, since: int) -> List[tuple[int, float]]:
+def _grouped(query: str, secret: str, since: int, bucket: int | None) -> np.ndarray | None:
+    """Выполнить агрегирующий запрос; NULL → NaN. None, если строк нет."""
+    if bucket is None:
+        bucket = bucket_for(int(time.time()) - since)
     with sql.lock, sql.conn.cursor() as cur:
-        cur.execute(
-            "SELECT ts, cpu, ram, gpu, vram, net_up, net_down FROM metrics WHERE secret=%s AND ts>=%s ORDER BY ts ASC",
-            (secret, since),
-        )
+        cur.execute(query, (secret, since, bucket))
         rows = cur.fetchall()
     if not rows:
-        return []
-
-    grouped: List[tuple] = []
-    chunk: List[tuple] = []
-    for r in rows:
-        chunk.append(r)
-        if len(chunk) == 6:
-            grouped.append(_avg_chunk(chunk))
-            chunk = []
-    if chunk:
-        grouped.append(_avg_chunk(chunk))
-    return grouped
-
-
-def _avg_chunk_full(chunk: List[tuple], avg_fn) -> Dict[str, Any]:
-    r_last = chunk[-1]
-    return {
-        "ts": r_last[0],
-        "cpu": avg_fn([r[1] for r in chunk]),
-        "ram": avg_fn([r[2] for r in chunk]),
-        "gpu": avg_fn([r[3] for r in chunk]),
-        "vram": avg_fn([r[4] for r in chunk]),
-        "net_up": avg_fn([r[5] for r in chunk]),
-        "net_down": avg_fn([r[6] for r in chunk]),
-        "ram_used": avg_fn([r[7] for r in chunk]),
-        "ram_total": r_last[8],
-        "vram_used": avg_fn([r[9] for r in chunk]),
-        "vram_total": r_last[10],
-    }
+        return None
+    return np.array(rows, dtype=float)
 
 
-def fetch_metrics_full(secret: str, since: int) -> List[Dict[str, Any]]:
-    with sql.lock, sql.conn.cursor() as cur:
-        cur.execute(
-            "SELECT ts, cpu, ram, gpu, vram, net_up, net_down, ram_used, ram_total, vram_used, vram_total FROM metrics WHERE secret=%s AND ts>=%s ORDER BY ts ASC",
-            (secret, since),
-        )
-        rows = cur.fetchall()
-    if not rows:
-        return []
+# усреднение на стороне MySQL: по строке на интервал bucket секунд,
+# время интервала — время последней строки в нём
+_FETCH_SQL = """SELECT MAX(ts), AVG(cpu), AVG(ram), AVG(gpu), AVG(vram),
+                  AVG(net_up), AVG(net_down)
+           FROM metrics WHERE secret=%s AND ts>=%s
+           GROUP BY ts DIV %s ORDER BY 1"""
 
-    def avg(vals):
-        vals = [v for v in vals if v is not None]
-        return sum(vals) / len(vals) if vals else None
 
-    grouped: List[Dict[str, Any]] = []
-    chunk: List[tuple] = []
-    for r in rows:
-        chunk.append(r)
-        if len(chunk) == 6:
-            grouped.append(_avg_chunk_full(chunk, avg))
-            chunk = []
-    if chunk:
-        grouped.append(_avg_chunk_full(chunk, avg))
-    return grouped
+def fetch_metrics(secret: str, since: int, bucket: int | None = None) -> np.ndarray:
+    """Массив n×7 (ts, cpu, ram, gpu, vram, net_up, net_down), усреднённый по bucket секунд."""
+    arr = _grouped(_FETCH_SQL, secret, since, bucket)
+    return np.empty((0, 7)) if arr is None else arr
 
 
-def load_db() -> Dict[str, Any]:
+FULL_COLS = (
+    "ts", "cpu", "ram", "gpu", "vram", "net_up", "net_down",
+    "ram_used", "ram_total", "vram_used", "vram_total",
+)
+_FETCH_FULL_SQL = """SELECT MAX(ts), AVG(cpu), AVG(ram), AVG(gpu), AVG(vram),
+                       AVG(net_up), AVG(net_down), AVG(ram_used), MAX(ram_total),
+                       AVG(vram_used), MAX(vram_total)
+                FROM metrics WHERE secret=%s AND ts>=%s
+                GROUP BY ts DIV %s ORDER BY 1"""
+
+
+def fetch_metrics_full(secret: str, since: int, bucket: int | None = None) -> np.ndarray:
+    """Массив с колонками FULL_COLS, усреднённый по bucket секунд."""
+    arr = _grouped(_FETCH_FULL_SQL, secret, since, bucket)
+    return np.empty((0, len(FULL_COLS))) if arr is None else arr
+
+
+# Состояние бота (ключи, владельцы, алерты) живёт в памяти: читается из MySQL
+# один раз, а save_db только сохраняет снимок. Все обработчики работают
+# с одним и тем же словарём.
+#
+# Записи ключей лежат в таблице secrets (строка на ключ), остальное
+# (active, alerts, alert_last) — одним JSON в state id=1. При записи
+# сравниваем с последним сохранённым и пишем только изменившиеся строки.
+_DB: Dict[str, Any] | None = None
+_DB_LOCK = threading.Lock()
+_WRITE_LOCK = threading.Lock()
+_written: Dict[str, bytes] = {}
+_written_rest: bytes = b""
+
+
+def _read_state() -> Dict[str, Any]:
+    global _written_rest
     with sql.lock, sql.conn.cursor() as cur:
         cur.execute("SELECT data FROM state WHERE id=1")
         row = cur.fetchone()
-    data = json.loads(row[0] if row and row[0] else "{}")
+        cur.execute("SELECT secret, data FROM secrets")
+        rows = cur.fetchall()
+    rest = row[0] if row and row[0] else "{}"
+    data = orjson.loads(rest)
+    if rows:
+        data["secrets"] = {}
+        for secret, blob in rows:
+            data["secrets"][secret] = orjson.loads(blob)
+            _written[secret] = blob.encode()
+        _written_rest = rest.encode()
+    # иначе ключи (если есть) остались в старом общем JSON: _written пуст,
+    # и первая запись перенесёт их в таблицу secrets
     data.setdefault("secrets", {})
     data.setdefault("active", {})
     data.setdefault("alerts", {})
     data.setdefault("alert_last", {})
+    # очередь команд агенту держим в памяти как deque
+    for entry in data["secrets"].values():
+        entry["pending"] = deque(entry.get("pending") or ())
     return data
 
 
+def _persistent_entry(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """Копия записи ключа без служебных полей (ключи с «_»).
+
+    Такие поля — индексы и кэши, которые живут только в памяти.
+    Очереди команд (deque) сохраняются списками.
+    """
+    return {
+        k: list(v) if isinstance(v, deque) else v
+        for k, v in entry.items()
+        if not k.startswith("_")
+    }
+
+
+def _dump_state(db: Dict[str, Any]) -> tuple[Dict[str, bytes], bytes]:
+    """Сериализовать состояние: JSON каждой записи ключа и всего остального."""
+    opt = orjson.OPT_NON_STR_KEYS
+    while True:
+        try:
+            entries = {
+                s: orjson.dumps(_persistent_entry(e), option=opt)
+                for s, e in list(db["secrets"].items())
+            }
+            rest = orjson.dumps({k: v for k, v in db.items() if k != "secrets"}, option=opt)
+            return entries, rest
+        except RuntimeError:
+            # словарь изменили из другого потока во время обхода
+            continue
+
+
+def load_db() -> Dict[str, Any]:
+    """Вернуть общий словарь состояния (без копирования)."""
+    global _DB
+    if _DB is None:
+        with _DB_LOCK:
+            if _DB is None:
+                _DB = _read_state()
+    return _DB
+
+
+def _write_state(db: Dict[str, Any]) -> None:
+    global _written_rest
+    with _WRITE_LOCK:
+        entries, rest = _dump_state(db)
+        changed = [(s, b) for s, b in entries.items() if _written.get(s) != b]
+        removed = [(s,) for s in _written.keys() - entries.keys()]
+        if not changed and not removed and rest == _written_rest:
+            return
+        with sql.lock, sql.conn.cursor() as cur:
+            sql.conn.begin()
+            try:
+                if changed:
+                    cur.executemany(
+                        "INSERT INTO secrets(secret, data) VALUES(%s, %s) "
+                        "ON DUPLICATE KEY UPDATE data=VALUES(data)",
+                        [(s, b.decode()) for s, b in changed],
+                    )
+                if removed:
+                    cur.executemany("DELETE FROM secrets WHERE secret=%s", removed)
+                if rest != _written_rest:
+                    cur.execute("UPDATE state SET data=%s WHERE id=1", (rest.decode(),))
+                sql.conn.commit()
+            except Exception:
+                sql.conn.rollback()
+                raise
+        for s, b in changed:
+            _written[s] = b
+        for (s,) in removed:
+            _written.pop(s, None)
+        _written_rest = rest
+
+
+# Групповая запись: save_db лишь помечает состояние изменённым, а фоновый
+# поток пишет снимок одним UPDATE. Все save_db, пришедшие во время записи
+# или в течение STATE_WRITE_DELAY после первой пометки, объединяются.
+STATE_WRITE_DELAY = 0.5
+_DB_DIRTY = threading.Event()
+_writer: threading.Thread | None = None
+
+
+def _writer_loop() -> None:
+    while True:
+        _DB_DIRTY.wait()
+        time.sleep(STATE_WRITE_DELAY)
+        _DB_DIRTY.clear()
+        try:
+            _write_state(load_db())
+        except Exception as exc:
+            log.warning("state write failed: %s", exc)
+            _DB_DIRTY.set()
+            time.sleep(1)
+
+
 def save_db(db: Dict[str, Any]) -> None:
-    with sql.lock, sql.conn.cursor() as cur:
-        cur.execute("UPDATE state SET data=%s WHERE id=1", (json.dumps(db),))
+    """Поставить сохранение состояния в очередь фоновой записи."""
+    global _writer
+    _DB_DIRTY.set()
+    if _writer is None:
+        with _DB_LOCK:
+            if _writer is None:
+                _writer = threading.Thread(target=_writer_loop, name="state-writer", daemon=True)
+                _writer.start()
+
+
+def flush_db() -> None:
+    """Синхронно записать несохранённое состояние (при остановке)."""
+    if _DB_DIRTY.is_set() and _DB is not None:
+        _DB_DIRTY.clear()
+        _write_state(_DB)
+
+
+atexit.register(flush_db)
 
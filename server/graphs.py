@@ -3,8 +3,7 @@ from __future__ import annotations
 
 import io
 import time
-from statistics import median
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import List
 import os
 import re
@@ -16,13 +15,26 @@ import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import numpy as np
 import gc
+from PIL import Image
 
-from .db import fetch_metrics, fetch_metrics_full
+from .db import FULL_COLS, fetch_metrics, fetch_metrics_full
 
 # matplotlib без X-сервера
 
 matplotlib.use("Agg")
 
+# стиль и размеры шрифтов общие для всех графиков — задаём один раз
+_FONT_BASE = 9
+plt.style.use("dark_background")
+plt.rcParams.update({
+    "font.size": _FONT_BASE,
+    "axes.titlesize": _FONT_BASE + 4,
+    "axes.labelsize": _FONT_BASE + 2,
+    "xtick.labelsize": _FONT_BASE - 1,
+    "ytick.labelsize": _FONT_BASE - 1,
+    "legend.fontsize": _FONT_BASE - 1,
+})
+
 # количество процессов берётся из переменной окружения
 # после завершения задачи исполнитель завершается, чтобы освободить память
 
@@ -45,27 +57,34 @@ def submit(func, *args, **kwargs) -> Future:
     return future
 
 
-def _find_gaps(ts, factor: float = 2.0):
-    if len(ts) < 2:
-        return [(0, len(ts) - 1)], [], 0
+def _find_gaps(ep: np.ndarray, factor: float = 2.0):
+    """Найти разрывы в ряду меток времени (секунды epoch).
+
+    Разрыв — интервал больше factor медианных. Возвращает сегменты без
+    разрывов (индексы начала и конца), разрывы как пары соседних индексов
+    и порог в секундах.
+    """
+    n = len(ep)
+    if n < 2:
+        return [(0, n - 1)], [], 0
 
-    intervals = [(ts[i] - ts[i - 1]).total_seconds() for i in range(1, len(ts))]
-    med = median(intervals) if intervals else 0
+    intervals = np.diff(ep)
+    med = float(np.median(intervals))
     if med <= 0:
-        med = max(intervals) if intervals else 60
+        med = float(intervals.max())
     thr = med * factor
 
-    segments, gaps = [], []
-    start = 0
-    for i, dt in enumerate(intervals, start=1):
-        if dt > thr:
-            segments.append((start, i - 1))
-            gaps.append((ts[i - 1], ts[i]))
-            start = i
-    segments.append((start, len(ts) - 1))
+    idx = np.flatnonzero(intervals > thr)
+    segments = list(zip(np.r_[0, idx + 1].tolist(), np.r_[idx, n - 1].tolist()))
+    gaps = list(zip(idx.tolist(), (idx + 1).tolist()))
     return segments, gaps, thr
 
 
+def _shade_gaps(ax, ts, gaps) -> None:
+    for i0, i1 in gaps:
+        ax.axvspan(ts[i0], ts[i1], facecolor="none", hatch="//", edgecolor="white", alpha=0.3, linewidth=0)
+
+
 TIME_RE = re.compile(r"^(\d+)([smhd])$", re.I)
 
 
@@ -89,19 +108,73 @@ def parse_timespan(tokens: List[str]) -> int:
     return total
 
 
+# сколько точек линии отдаём matplotlib; длинные ряды прореживаются LTTB
+LTTB_POINTS = 2000
+
+
+def lttb_indices(ys: np.ndarray, n_out: int) -> np.ndarray:
+    """Индексы n_out точек ряда по алгоритму Largest-Triangle-Three-Buckets.
+
+    По оси X берётся номер точки: внутри сегмента без разрывов отсчёты
+    идут равномерно. Первая и последняя точки сохраняются всегда.
+    Вершина A — среднее предыдущей корзины, а не выбранная в ней точка:
+    так корзины независимы и считаются все сразу, без цикла по корзинам.
+    """
+    n = len(ys)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    # n_out корзин: [0, 1), n_out - 2 внутренних, [n - 1, n)
+    bounds = np.concatenate(([0], np.linspace(1, n - 1, n_out - 1).astype(np.int64), [n]))
+    lo, hi = bounds[:-1], bounds[1:]
+    valid = ~np.isnan(ys)
+    sums = np.add.reduceat(np.where(valid, ys, 0.0), lo)
+    cnts = np.add.reduceat(valid.astype(np.int64), lo)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_y = sums / cnts
+    mean_x = (lo + hi - 1) / 2
+
+    # внутренние корзины: A — средние слева, C — средние справа
+    ax, ay = mean_x[:-2, None], mean_y[:-2, None]
+    cx, cy = mean_x[2:, None], mean_y[2:, None]
+    ilo, ihi = lo[1:-1, None], hi[1:-1, None]
+    xs = ilo + np.arange((hi - lo)[1:-1].max())
+    inside = xs < ihi
+    xs = np.minimum(xs, n - 1)
+    area = np.abs((ax - cx) * (ys[xs] - ay) - (ax - xs) * (cy - ay))
+    area = np.where(inside, np.nan_to_num(area, nan=-1.0), -2.0)
+
+    out = np.empty(n_out, dtype=np.int64)
+    out[0], out[-1] = 0, n - 1
+    out[1:-1] = xs[np.arange(n_out - 2), area.argmax(axis=1)]
+    return out
+
+
 def _plot_segments(ax, ts, ys, segments, *args, **kwargs):
+    ys = np.asarray(ys, dtype=float)
+    total = len(ys)
     first = True
     col = None
     for s, e in segments:
+        xs_seg, ys_seg = ts[s:e + 1], ys[s:e + 1]
+        if total > LTTB_POINTS:
+            # каждому сегменту — доля точек по его длине
+            idx = lttb_indices(ys_seg, max(3, LTTB_POINTS * len(ys_seg) // total))
+            xs_seg, ys_seg = np.asarray(xs_seg)[idx], ys_seg[idx]
         if first:
-            line, = ax.plot(ts[s:e + 1], ys[s:e + 1], *args, **kwargs)
+            line, = ax.plot(xs_seg, ys_seg, *args, **kwargs)
             col = line.get_color()
             first = False
         else:
             kw = dict(kwargs)
             kw.pop("label", None)
             kw["color"] = col
-            ax.plot(ts[s:e + 1], ys[s:e + 1], *args, **kw)
+            ax.plot(xs_seg, ys_seg, *args, **kw)
+
+
+# Telegram принимает фото с суммой сторон до 10000 px: 24×6 дюймов
+# при 150 dpi — 3600×900, этого с запасом хватает на LTTB_POINTS точек
+FIG_DPI = 150
+FIG_MAX_WIDTH = 24
 
 
 def _make_figure(seconds: int):
@@ -110,21 +183,32 @@ def _make_figure(seconds: int):
     width = 12
     if days >= 1:
         width *= 1.5 if days < 1.5 else days
-    dpi = 500
-    fig, ax = plt.subplots(figsize=(width, 6), dpi=dpi)
-
-    base = 9
-    plt.rcParams.update({
-        "font.size": base,
-        "axes.titlesize": base + 4,
-        "axes.labelsize": base + 2,
-        "xtick.labelsize": base - 1,
-        "ytick.labelsize": base - 1,
-        "legend.fontsize": base - 1,
-    })
+    width = min(width, FIG_MAX_WIDTH)
+    fig, ax = plt.subplots(figsize=(width, 6), dpi=FIG_DPI)
     return fig, ax
 
 
+JPEG_QUALITY = 85
+
+
+def _render(fig) -> io.BytesIO:
+    """Отрисовать фигуру в JPEG-буфер и освободить её.
+
+    Telegram всё равно пережимает фото в JPEG, поэтому PNG (zlib) —
+    лишняя работа: кодируем готовый RGBA-буфер Agg через Pillow.
+    """
+    plt.tight_layout()
+    fig.canvas.draw()
+    img = Image.fromarray(np.asarray(fig.canvas.buffer_rgba())).convert("RGB")
+    plt.close(fig)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=JPEG_QUALITY)
+    buf.name = "plot.jpg"
+    gc.collect()
+    buf.seek(0)
+    return buf
+
+
 def _apply_time_locator(ax, seconds: int) -> None:
     """Настроить частоту меток времени в зависимости от интервала."""
     hours = seconds / 3600
@@ -156,12 +240,43 @@ def best_unit(max_val_bytes: float) -> tuple[float, str]:
     return scale_bits / 8, unit
 
 
+# переходы на летнее/зимнее время приходятся на границы 15-минутных интервалов
+_TZ_STEP = 15 * 60
+
+
+def _local_times(ep: np.ndarray) -> np.ndarray:
+    """Секунды epoch → datetime64 в локальном времени сервера.
+
+    Как datetime.fromtimestamp: смещение пояса своё для каждой точки, и ряд
+    через переход на летнее время не съезжает. Смещение считается один раз
+    на интервал _TZ_STEP и раздаётся точкам через np.unique.
+    """
+    sec = ep.astype(np.int64)
+    cells, inv = np.unique(sec // _TZ_STEP, return_inverse=True)
+    offs = np.array(
+        [
+            datetime.fromtimestamp(int(c) * _TZ_STEP, timezone.utc).astimezone().utcoffset().total_seconds()
+            for c in cells
+        ],
+        dtype=np.int64,
+    )
+    return (sec + offs[inv.ravel()]).astype("datetime64[s]")
+
+
+def _nanmax(*cols: np.ndarray) -> float:
+    """Максимум по колонкам без NaN; 0, если значений нет."""
+    vals = np.concatenate(cols)
+    vals = vals[~np.isnan(vals)]
+    return float(vals.max()) if len(vals) else 0.0
+
+
 def plot_metric(secret: str, metric: str, seconds: int):
     rows = fetch_metrics(secret, int(time.time()) - seconds)
-    if not rows:
+    if not len(rows):
         return None
 
-    ts = [datetime.fromtimestamp(r[0]) for r in rows]
+    ep = rows[:, 0]
+    ts = _local_times(ep)
 
     idx_map = {
         "cpu": (1, "CPU %", "%", (0, 100)),
@@ -172,26 +287,24 @@ def plot_metric(secret: str, metric: str, seconds: int):
         "net_down": (6, "Net Down", "bit/s", None),
     }
     col_idx, label, ylab, ylim = idx_map[metric]
-    ys = [np.nan if rows[i][col_idx] is None else rows[i][col_idx] for i in range(len(rows))]
+    ys = rows[:, col_idx]
 
     if metric.startswith("net_"):
-        max_val = max([v for v in ys if not np.isnan(v)] or [0])
+        max_val = _nanmax(ys)
         scale, unit = best_unit(max_val)
         if scale != 1:
-            ys = [v / scale if not np.isnan(v) else np.nan for v in ys]
+            ys = ys / scale
         ylab = unit
         if max_val:
             ylim = (0, (max_val / scale) * 1.1)
 
-    segments, gaps, _ = _find_gaps(ts)
+    segments, gaps, _ = _find_gaps(ep)
 
-    plt.style.use("dark_background")
     fig, ax = _make_figure(seconds)
 
     _plot_segments(ax, ts, ys, segments, linewidth=1.5)
 
-    for g0, g1 in gaps:
-        ax.axvspan(g0, g1, facecolor="none", hatch="//", edgecolor="white", alpha=0.3, linewidth=0)
+    _shade_gaps(ax, ts, gaps)
 
     ax.set_title(f"{label} за {timedelta(seconds=seconds)}")
     ax.set_xlabel("Время")
@@ -202,41 +315,34 @@ def plot_metric(secret: str, metric: str, seconds: int):
     _apply_time_locator(ax, seconds)
     fig.autofmt_xdate()
 
-    buf = io.BytesIO()
-    plt.tight_layout()
-    fig.savefig(buf, dpi=fig.dpi, format="png")
-    plt.close(fig)
-    gc.collect()
-    buf.seek(0)
-    return buf
+    return _render(fig)
 
 
 def plot_net(secret: str, seconds: int):
     rows = fetch_metrics(secret, int(time.time()) - seconds)
-    if not rows:
+    if not len(rows):
         return None
 
-    ts = [datetime.fromtimestamp(r[0]) for r in rows]
-    up = [np.nan if r[5] is None else r[5] for r in rows]
-    down = [np.nan if r[6] is None else r[6] for r in rows]
-    max_val = max([v for v in up + down if not np.isnan(v)] or [0])
+    ep = rows[:, 0]
+    ts = _local_times(ep)
+    up = rows[:, 5]
+    down = rows[:, 6]
+    max_val = _nanmax(up, down)
     scale, unit = best_unit(max_val)
     if scale != 1:
-        up = [v / scale if not np.isnan(v) else np.nan for v in up]
-        down = [v / scale if not np.isnan(v) else np.nan for v in down]
+        up = up / scale
+        down = down / scale
     ylim_top = None
     if max_val:
         ylim_top = (max_val / scale) * 1.1
-    segments, gaps, _ = _find_gaps(ts)
+    segments, gaps, _ = _find_gaps(ep)
 
-    plt.style.use("dark_background")
     fig, ax = _make_figure(seconds)
 
     _plot_segments(ax, ts, up, segments, label="Up", linewidth=1.2)
     _plot_segments(ax, ts, down, segments, label="Down", linewidth=1.2)
 
-    for g0, g1 in gaps:
-        ax.axvspan(g0, g1, facecolor="none", hatch="//", edgecolor="white", alpha=0.3, linewidth=0)
+    _shade_gaps(ax, ts, gaps)
 
     ax.set_title(f"Net за {timedelta(seconds=seconds)}")
     ax.set_xlabel("Время")
@@ -248,41 +354,30 @@ def plot_net(secret: str, seconds: int):
     ax.legend(loc="upper left", fontsize="small")
     fig.autofmt_xdate()
 
-    buf = io.BytesIO()
-    plt.tight_layout()
-    fig.savefig(buf, dpi=fig.dpi, format="png")
-    plt.close(fig)
-    gc.collect()
-    buf.seek(0)
-    return buf
+    return _render(fig)
 
 
 def plot_all_metrics(secret: str, seconds: int):
     rows = fetch_metrics(secret, int(time.time()) - seconds)
-    if not rows:
+    if not len(rows):
         return None
 
-    ts = [datetime.fromtimestamp(r[0]) for r in rows]
-    segments, gaps, _ = _find_gaps(ts)
-
-    cpu = [r[1] for r in rows]
-    ram = [r[2] for r in rows]
-    gpu = [np.nan if r[3] is None else r[3] for r in rows]
-    vram = [np.nan if r[4] is None else r[4] for r in rows]
+    ep = rows[:, 0]
+    ts = _local_times(ep)
+    segments, gaps, _ = _find_gaps(ep)
 
-    plt.style.use("dark_background")
+    cpu, ram, gpu, vram = rows[:, 1], rows[:, 2], rows[:, 3], rows[:, 4]
 
     fig, ax = _make_figure(seconds)
 
     for ys, lab in ((cpu, "CPU %"), (ram, "RAM %")):
         _plot_segments(ax, ts, ys, segments, label=lab, linewidth=1.2)
-    if not all(np.isnan(g) for g in gpu):
+    if not np.isnan(gpu).all():
         _plot_segments(ax, ts, gpu, segments, label="GPU %", linewidth=1.2)
-    if not all(np.isnan(v) for v in vram):
+    if not np.isnan(vram).all():
         _plot_segments(ax, ts, vram, segments, label="VRAM %", linewidth=1.2)
 
-    for g0, g1 in gaps:
-        ax.axvspan(g0, g1, facecolor="none", hatch="//", edgecolor="white", alpha=0.3, linewidth=0)
+    _shade_gaps(ax, ts, gaps)
 
     ax.set_ylim(0, 100)
     ax.set_title(f"Все метрики за {timedelta(seconds=seconds)}")
@@ -293,13 +388,7 @@ def plot_all_metrics(secret: str, seconds: int):
     ax.legend(loc="upper left", fontsize="small")
     fig.autofmt_xdate()
 
-    buf = io.BytesIO()
-    plt.tight_layout()
-    fig.savefig(buf, dpi=fig.dpi, format="png")
-    plt.close(fig)
-    gc.collect()
-    buf.seek(0)
-    return buf
+    return _render(fig)
 
 
 MEM_UNITS = {
@@ -322,19 +411,19 @@ NET_UNITS = {
 
 def plot_custom(secret: str, metrics: list[str], seconds: int, ylim_top: float | None, unit: str | None):
     rows = fetch_metrics_full(secret, int(time.time()) - seconds)
-    if not rows:
+    if not len(rows):
         return None
 
-    ts = [datetime.fromtimestamp(r["ts"]) for r in rows]
-    segments, gaps, _ = _find_gaps(ts)
+    col = dict(zip(FULL_COLS, rows.T))
+    ts = _local_times(col["ts"])
+    segments, gaps, _ = _find_gaps(col["ts"])
 
-    plt.style.use("dark_background")
     fig, ax = _make_figure(seconds)
 
     unit_category = None
     ylab = unit
 
-    data_sets: list[tuple[list[float], str]] = []
+    data_sets: list[tuple[np.ndarray, str]] = []
 
     for m in metrics:
         m = m.lower()
@@ -345,44 +434,44 @@ def plot_custom(secret: str, metrics: list[str], seconds: int, ylim_top: float |
     for m in metrics:
         m = m.lower()
         label = m.upper()
-        ys = []
+        ys = None
         cat = ""
         default_unit = "%"
 
         if m == "cpu":
-            ys = [r["cpu"] for r in rows]
+            ys = col["cpu"]
             cat = "percent"
         elif m == "gpu":
-            ys = [r["gpu"] for r in rows]
+            ys = col["gpu"]
             cat = "percent"
         elif m == "ram":
             if unit and unit.lower() not in {"%", "percent"}:
                 factor = MEM_UNITS.get(unit.lower(), 1024 ** 2)
-                ys = [r["ram_used"] / factor if r["ram_used"] is not None else np.nan for r in rows]
+                ys = col["ram_used"] / factor
                 cat = "bytes"
                 default_unit = unit
             else:
-                ys = [r["ram"] for r in rows]
+                ys = col["ram"]
                 cat = "percent"
         elif m == "vram":
             if unit and unit.lower() not in {"%", "percent"}:
                 factor = MEM_UNITS.get(unit.lower(), 1024 ** 2)
-                ys = [r["vram_used"] / factor if r["vram_used"] is not None else np.nan for r in rows]
+                ys = col["vram_used"] / factor
                 cat = "bytes"
                 default_unit = unit
             else:
-                ys = [r["vram"] for r in rows]
+                ys = col["vram"]
                 cat = "percent"
         elif m == "net_up":
             cat = "net"
             default_unit = "bit/s"
             if unit and unit.lower() in NET_UNITS:
                 scale = NET_UNITS[unit.lower()]
-                ys = [r["net_up"] * 8 / scale if r["net_up"] is not None else np.nan for r in rows]
+                ys = col["net_up"] * 8 / scale
             else:
-                max_val = max([r["net_up"] or 0 for r in rows])
+                max_val = _nanmax(col["net_up"])
                 scale, auto_unit = best_unit(max_val)
-                ys = [r["net_up"] / scale if r["net_up"] is not None else np.nan for r in rows]
+                ys = col["net_up"] / scale
                 if not unit:
                     ylab = auto_unit
             label = "Up"
@@ -391,11 +480,11 @@ def plot_custom(secret: str, metrics: list[str], seconds: int, ylim_top: float |
             default_unit = "bit/s"
             if unit and unit.lower() in NET_UNITS:
                 scale = NET_UNITS[unit.lower()]
-                ys = [r["net_down"] * 8 / scale if r["net_down"] is not None else np.nan for r in rows]
+                ys = col["net_down"] * 8 / scale
             else:
-                max_val = max([r["net_down"] or 0 for r in rows])
+                max_val = _nanmax(col["net_down"])
                 scale, auto_unit = best_unit(max_val)
-                ys = [r["net_down"] / scale if r["net_down"] is not None else np.nan for r in rows]
+                ys = col["net_down"] / scale
                 if not unit:
                     ylab = auto_unit
             label = "Down"
@@ -414,8 +503,7 @@ def plot_custom(secret: str, metrics: list[str], seconds: int, ylim_top: float |
     for ys, lab in data_sets:
         _plot_segments(ax, ts, ys, segments, label=lab, linewidth=1.2)
 
-    for g0, g1 in gaps:
-        ax.axvspan(g0, g1, facecolor="none", hatch="//", edgecolor="white", alpha=0.3, linewidth=0)
+    _shade_gaps(ax, ts, gaps)
 
     ax.set_xlabel("Время")
     ax.set_ylabel(ylab or "%")
@@ -428,10 +516,4 @@ def plot_custom(secret: str, metrics: list[str], seconds: int, ylim_top: float |
         ax.legend(loc="upper left", fontsize="small")
     fig.autofmt_xdate()
 
-    buf = io.BytesIO()
-    plt.tight_layout()
-    fig.savefig(buf, dpi=fig.dpi, format="png")
-    plt.close(fig)
-    gc.collect()
-    buf.seek(0)
-    return buf
+    return _render(fig)